@@ -1,6 +1,18 @@
+import asyncio
+
 from sanic import Sanic
 
 from service.blue_print import bp as bp_bp
+from service.jobs import transaction_jobs
+from service.journal import journal
+from service.processor_endpoints import probe_processor_endpoints
+from service.environment import is_qa_environment
+from service.logger import get_logger
+from service.loop_monitor import loop_monitor
+from service.upstreams import close_upstreams
+from service.warm_start import take_snapshot, warm_up, write_snapshot, write_snapshots_periodically
+
+logger = get_logger()
 
 app = Sanic("GatewayPointToPointService")
 
@@ -18,3 +30,68 @@ app.config.KEEP_ALIVE_TIMEOUT = 300
 app.config.REQUEST_BUFFER_SIZE = 131072
 app.config.REQUEST_MAX_HEADER_SIZE = 24576
 app.config.FALLBACK_ERROR_FORMAT = "json"
+
+
+@app.before_server_start
+async def start_journal(app, loop):
+    journal.start()
+
+
+@app.after_server_stop
+async def stop_journal(app, loop):
+    journal.stop()
+
+
+@app.before_server_start
+async def start_transaction_jobs(app, loop):
+    transaction_jobs.start()
+
+
+@app.before_server_stop
+async def stop_transaction_jobs(app, loop):
+    await transaction_jobs.stop()
+
+
+@app.after_server_start
+async def start_processor_endpoint_probes(app, loop):
+    app.ctx.processor_endpoint_probes = asyncio.create_task(probe_processor_endpoints())
+
+
+@app.before_server_stop
+async def stop_processor_endpoint_probes(app, loop):
+    app.ctx.processor_endpoint_probes.cancel()
+
+
+@app.before_server_start
+async def warm_start(app, loop):
+    # Sanic only reports the worker ready once its before_server_start listeners finish
+    await warm_up(is_qa_environment())
+
+
+@app.after_server_start
+async def start_snapshots(app, loop):
+    app.ctx.snapshots = asyncio.create_task(write_snapshots_periodically())
+
+
+@app.before_server_stop
+async def stop_snapshots(app, loop):
+    app.ctx.snapshots.cancel()
+    try:
+        write_snapshot(take_snapshot())
+    except OSError:
+        logger.exception("Unable to write the final snapshot")
+
+
+@app.after_server_stop
+async def close_upstream_connections(app, loop):
+    await close_upstreams()
+
+
+@app.after_server_start
+async def start_loop_monitor(app, loop):
+    app.ctx.loop_monitor = asyncio.create_task(loop_monitor.run())
+
+
+@app.before_server_stop
+async def stop_loop_monitor(app, loop):
+    app.ctx.loop_monitor.cancel()
@@ -0,0 +1,212 @@
+"""
+Heavy hitter and cost accounting per tenant, merchant and terminal.
+
+Every request's cost (its latency, whether it failed, whether the
+passthrough had to be asked for credentials, and the time spent on EPX)
+is charged to its API key, its MERCH_NBR and its terminal. Each of those
+is tracked in a space-saving sketch of HEAVY_HITTER_CAPACITY entries,
+so memory stays fixed however many keys there are:
+
+- a key already in the sketch is charged directly,
+- a new key takes over the entry with the lowest count, inheriting that
+  count as its possible overestimate.
+
+Any key seen more than total / capacity times is guaranteed a place,
+and its count is off by at most its overestimate. The cost sums of a
+key only cover the time since it last entered the sketch, so they are
+lower bounds.
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from functools import wraps
+from typing import Any, Dict, Iterator, List, Optional
+
+from service.scheduling import ANONYMOUS_TENANT, current_tenant
+
+HEAVY_HITTER_CAPACITY = int(os.getenv("HEAVY_HITTER_CAPACITY", "200"))
+
+SORT_KEYS = ("count", "latency_sum", "errors", "passthrough_misses", "epx_latency_sum")
+
+
+@dataclass
+class HeavyHitter:
+    """
+    One key's counts and costs in a sketch
+    """
+    key: str
+    count: int = 0
+    overestimate: int = 0
+    latency_sum: float = 0.0
+    errors: int = 0
+    passthrough_misses: int = 0
+    epx_calls: int = 0
+    epx_latency_sum: float = 0.0
+
+
+@dataclass
+class RequestCost:
+    """
+    What one request cost, gathered while it runs
+    """
+    merchant: Optional[str] = None
+    terminal: Optional[str] = None
+    error: bool = False
+    passthrough_misses: int = 0
+    epx_calls: int = 0
+    epx_latency: float = 0.0
+
+
+class SpaceSaving:
+    """
+    Space-saving top-k sketch with costs kept per entry
+    """
+
+    def __init__(self, capacity: int = HEAVY_HITTER_CAPACITY):
+        self.capacity = capacity
+        self.entries: Dict[str, HeavyHitter] = {}
+        self.total = 0
+
+    def record(self, key: str, latency: float, cost: RequestCost) -> None:
+        """
+        Charges a request's cost to a key.
+
+        :param key: str
+        :param latency: float seconds
+        :param cost: RequestCost
+        :return: None
+        """
+        self.total += 1
+        entry = self.entries.get(key)
+        if entry is None:
+            if len(self.entries) < self.capacity:
+                entry = HeavyHitter(key)
+            else:
+                # Linear in the capacity, which is kept small, and only paid on a miss
+                evicted = min(self.entries.values(), key=lambda candidate: candidate.count)
+                del self.entries[evicted.key]
+                entry = HeavyHitter(key, count=evicted.count, overestimate=evicted.count)
+            self.entries[key] = entry
+
+        entry.count += 1
+        entry.latency_sum += latency
+        entry.errors += cost.error
+        entry.passthrough_misses += cost.passthrough_misses
+        entry.epx_calls += cost.epx_calls
+        entry.epx_latency_sum += cost.epx_latency
+
+    def top(self, limit: int, by: str = "count") -> List[Dict[str, Any]]:
+        """
+        Returns the entries with the most of a count or cost.
+
+        :param limit: int
+        :param by: str one of SORT_KEYS
+        :return: List[Dict[str, Any]]
+        """
+        entries = sorted(self.entries.values(), key=lambda entry: getattr(entry, by), reverse=True)[:limit]
+        return [
+            {**asdict(entry), "latency_sum": round(entry.latency_sum, 4), "epx_latency_sum": round(entry.epx_latency_sum, 4)}
+            for entry in entries
+        ]
+
+
+tenants = SpaceSaving()
+merchants = SpaceSaving()
+terminals = SpaceSaving()
+
+_current_cost: ContextVar[Optional[RequestCost]] = ContextVar("request_cost", default=None)
+
+
+@contextmanager
+def account_request() -> Iterator[RequestCost]:
+    """
+    Gathers the cost of everything done within the block and charges it on the way out.
+
+    An exception escaping the block counts as an error.
+    """
+    cost = RequestCost()
+    token = _current_cost.set(cost)
+    started = time.monotonic()
+    try:
+        yield cost
+    except BaseException:
+        cost.error = True
+        raise
+    finally:
+        _current_cost.reset(token)
+        latency = time.monotonic() - started
+        tenant = current_tenant()
+        # Hash prefixes are enough to tell tenants apart
+        tenants.record(tenant if tenant == ANONYMOUS_TENANT else tenant[:16], latency, cost)
+        if cost.merchant is not None:
+            merchants.record(cost.merchant, latency, cost)
+        if cost.terminal is not None:
+            terminals.record(cost.terminal, latency, cost)
+
+
+def accounted(handler):
+    """
+    Route decorator charging each request's cost, a 4xx or 5xx answer counting as an error.
+
+    Goes below scheduled_as_caller, so the tenant is known.
+    """
+    @wraps(handler)
+    async def wrapper(request, *args, **kwargs):
+        with account_request() as cost:
+            response = await handler(request, *args, **kwargs)
+            if response is not None and response.status >= 400:
+                cost.error = True
+            return response
+    return wrapper
+
+
+def note_merchant(merch_nbr: Any, terminal_nbr: Any = None) -> None:
+    """
+    Charges the current request to a merchant, and to its EPX terminal if given.
+    """
+    cost = _current_cost.get()
+    if cost is not None:
+        cost.merchant = str(merch_nbr)
+        if terminal_nbr is not None and cost.terminal is None:
+            cost.terminal = f"{merch_nbr}/{terminal_nbr}"
+
+
+def note_terminal(terminal_id: str) -> None:
+    """
+    Charges the current request to a terminal by its id.
+    """
+    cost = _current_cost.get()
+    if cost is not None:
+        cost.terminal = terminal_id
+
+
+def note_passthrough_miss() -> None:
+    cost = _current_cost.get()
+    if cost is not None:
+        cost.passthrough_misses += 1
+
+
+def note_epx_call(latency: float) -> None:
+    cost = _current_cost.get()
+    if cost is not None:
+        cost.epx_calls += 1
+        cost.epx_latency += latency
+
+
+def heavy_hitters(limit: int, by: str = "count") -> Dict[str, Any]:
+    """
+    Returns the top tenants, merchants and terminals by a count or cost.
+
+    :param limit: int
+    :param by: str one of SORT_KEYS
+    :return: Dict[str, Any]
+    """
+    return {
+        "capacity": HEAVY_HITTER_CAPACITY,
+        "by": by,
+        "tenants": {"total": tenants.total, "top": tenants.top(limit, by)},
+        "merchants": {"total": merchants.total, "top": merchants.top(limit, by)},
+        "terminals": {"total": terminals.total, "top": terminals.top(limit, by)},
+    }
@@ -0,0 +1,224 @@
+"""
+Adaptive admission control in front of the /p2pe routes.
+
+The concurrency limit follows AIMD: it grows by roughly one request per
+limit's worth of completions while observed latency stays under target,
+and is cut multiplicatively once latency goes over it. Requests beyond
+the limit are shed straight away instead of queueing behind a slow
+upstream.
+
+The latency observed is the time a request's upstream calls took, not
+its wall time: time spent waiting for an upstream slot or for the
+tenant's rate limit says nothing about how the upstreams are doing, and
+would have the limit shrink under a single tenant's burst. Requests which
+made no upstream call leave the limit alone.
+
+Transactions may use the whole limit, while remote key injection
+traffic is held to a share of it so it can never crowd out sales.
+"""
+import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from enum import Enum
+from functools import wraps
+from typing import Any, AsyncIterator, Dict, Optional
+
+from sanic import SanicException
+
+from service.logger import get_logger
+from service.metrics import register_metrics
+
+logger = get_logger()
+
+
+class Priority(Enum):
+    """
+    Traffic classes, in order of importance
+    """
+    TRANSACTION = "transaction"
+    KEY_INJECTION = "key_injection"
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is shed because the service is at its limit
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__("Service is at capacity, please retry.")
+        self.retry_after = retry_after
+
+
+@dataclass
+class UpstreamTime:
+    """
+    Time an admitted request spent in upstream calls
+    """
+    calls: int = 0
+    seconds: float = 0.0
+
+
+_current_upstream_time: ContextVar[Optional[UpstreamTime]] = ContextVar("upstream_time", default=None)
+
+
+def note_upstream_call(seconds: float) -> None:
+    """
+    Adds an upstream call's duration to the current request's, if it was admitted.
+
+    :param seconds: float
+    :return: None
+    """
+    upstream_time = _current_upstream_time.get()
+    if upstream_time is not None:
+        upstream_time.calls += 1
+        upstream_time.seconds += seconds
+
+
+class AdmissionController:
+    """
+    Concurrency limiter driven by observed upstream latency
+    """
+
+    def __init__(
+        self,
+        initial_limit: float = 20,
+        min_limit: float = 2,
+        max_limit: float = 200,
+        target_latency: float = 2.0,
+        backoff: float = 0.9,
+        key_injection_share: float = 0.8,
+        retry_after: int = 1,
+    ):
+        """
+        :param initial_limit: float
+        :param min_limit: float
+        :param max_limit: float
+        :param target_latency: float seconds; slower completions shrink the limit
+        :param backoff: float multiplier applied to the limit on a slow completion
+        :param key_injection_share: float share of the limit key injection may use
+        :param retry_after: int seconds sent back on shed requests
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.key_injection_share = key_injection_share
+        self.retry_after = retry_after
+
+        self.in_flight = 0
+        self.admitted = {priority: 0 for priority in Priority}
+        self.rejected = {priority: 0 for priority in Priority}
+        self.last_backoff = 0.0
+
+    @classmethod
+    def from_environment(cls) -> "AdmissionController":
+        return cls(
+            initial_limit=float(os.getenv("ADMISSION_INITIAL_LIMIT", "20")),
+            min_limit=float(os.getenv("ADMISSION_MIN_LIMIT", "2")),
+            max_limit=float(os.getenv("ADMISSION_MAX_LIMIT", "200")),
+            target_latency=float(os.getenv("ADMISSION_TARGET_LATENCY", "2.0")),
+            key_injection_share=float(os.getenv("ADMISSION_KEY_INJECTION_SHARE", "0.8")),
+            retry_after=int(os.getenv("ADMISSION_RETRY_AFTER", "1")),
+        )
+
+    def limit_for(self, priority: Priority) -> int:
+        if priority is Priority.TRANSACTION:
+            return max(1, int(self.limit))
+        return max(1, int(self.limit * self.key_injection_share))
+
+    def try_acquire(self, priority: Priority) -> bool:
+        """
+        Takes a slot if the priority's limit allows it.
+
+        :param priority: Priority
+        :return: bool
+        """
+        if self.in_flight >= self.limit_for(priority):
+            self.rejected[priority] += 1
+            return False
+
+        self.in_flight += 1
+        self.admitted[priority] += 1
+        return True
+
+    def release(self, latency: Optional[float]) -> None:
+        """
+        Gives a slot back and adjusts the limit from the observed latency.
+
+        :param latency: float seconds the request's upstream calls took, None if it made none
+        :return: None
+        """
+        self.in_flight -= 1
+        if latency is None:
+            return
+
+        now = time.monotonic()
+
+        if latency > self.target_latency:
+            # Back off at most once per target interval, so one burst of
+            # slow completions doesn't collapse the limit to the floor
+            if now - self.last_backoff >= self.target_latency:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_backoff = now
+                logger.info(f"Admission limit reduced to {self.limit:.1f} after {latency:.3f}s upstream")
+        elif self.in_flight + 1 >= self.limit / 2:
+            # Only grow while the limit is actually being used
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    @asynccontextmanager
+    async def admit(self, priority: Priority) -> AsyncIterator[None]:
+        """
+        Holds a slot for the duration of the block, or raises AdmissionRejected.
+
+        :param priority: Priority
+        """
+        if not self.try_acquire(priority):
+            raise AdmissionRejected(self.retry_after)
+
+        upstream_time = UpstreamTime()
+        token = _current_upstream_time.set(upstream_time)
+        try:
+            yield
+        finally:
+            _current_upstream_time.reset(token)
+            self.release(upstream_time.seconds if upstream_time.calls else None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "limits": {priority.value: self.limit_for(priority) for priority in Priority},
+            "admitted": {priority.value: count for priority, count in self.admitted.items()},
+            "rejected": {priority.value: count for priority, count in self.rejected.items()},
+        }
+
+
+admission_controller = AdmissionController.from_environment()
+register_metrics("admission", admission_controller.snapshot)
+
+
+def admission_control(priority: Priority):
+    """
+    Route decorator shedding requests with a 503 and Retry-After once the limit is reached.
+
+    :param priority: Priority
+    """
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request, *args, **kwargs):
+            try:
+                async with admission_controller.admit(priority):
+                    return await handler(request, *args, **kwargs)
+            except AdmissionRejected as e:
+                logger.info(f"Shedding {priority.value} request to {request.path}")
+                raise SanicException(
+                    str(e),
+                    status_code=503,
+                    headers={"Retry-After": str(e.retry_after)},
+                    quiet=True,
+                )
+        return wrapper
+    return decorator
@@ -1,12 +1,31 @@
-import aiohttp
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from dataclasses import asdict
+from functools import wraps
+from typing import Any, Dict, List, Optional, Tuple
 
 from sanic import json, Request
 
+from service.accounting import note_merchant, note_passthrough_miss
+from service.deadline import DeadlineExceeded, upstream_timeout
 from service.logger import get_logger
+from service.metrics import register_metrics
 from service.models import EPXCredentials
+from service.scheduling import ANONYMOUS_TENANT, tenant_scope, upstream_slot
+from service.upstreams import passthrough
 
 logger = get_logger()
 
+PASSTHROUGH_DEADLINE_SHARE = 0.3
+
+# How long an authorized key's credentials are used without asking the passthrough again, 0 to always ask.
+# Off by default: while cached, a revoked key or a merchant removed from EPX keeps being authorized.
+CREDENTIAL_CACHE_TTL = float(os.getenv("CREDENTIAL_CACHE_TTL", "0"))
+CREDENTIAL_CACHE_SIZE = int(os.getenv("CREDENTIAL_CACHE_SIZE", "10000"))
+
 
 class CredentialingError(Exception):
     """
@@ -15,18 +34,89 @@ class CredentialingError(Exception):
     pass
 
 
+class CredentialCache:
+    """
+    LRU cache of the credentials of recently authorized keys, keyed by the key's hash.
+
+    Expiry is wall clock time, so entries keep their age across a snapshot and restore.
+    """
+
+    def __init__(self, ttl: float = CREDENTIAL_CACHE_TTL, max_size: int = CREDENTIAL_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: "OrderedDict[Tuple[str, bool], Tuple[float, EPXCredentials]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, api_key_hash: str, is_qa: bool) -> Optional[EPXCredentials]:
+        entry = self.entries.get((api_key_hash, is_qa))
+        if entry is None or entry[0] < time.time():
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end((api_key_hash, is_qa))
+        self.hits += 1
+        return entry[1]
+
+    def put(self, api_key_hash: str, is_qa: bool, credentials: EPXCredentials, expires_at: Optional[float] = None) -> None:
+        if self.ttl <= 0:
+            return
+        self.entries[(api_key_hash, is_qa)] = (expires_at or time.time() + self.ttl, credentials)
+        self.entries.move_to_end((api_key_hash, is_qa))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def dump(self) -> List[Dict[str, Any]]:
+        """
+        Returns the unexpired entries, least recently used first.
+        """
+        now = time.time()
+        return [
+            {"key": key, "is_qa": is_qa, "expires_at": expires_at, "credentials": asdict(credentials)}
+            for (key, is_qa), (expires_at, credentials) in self.entries.items()
+            if expires_at >= now
+        ]
+
+    def load(self, entries: List[Dict[str, Any]]) -> int:
+        """
+        Puts back entries from `dump`, skipping any which have expired since.
+
+        :return: int of entries restored
+        """
+        if self.ttl <= 0:
+            return 0
+
+        now = time.time()
+        restored = 0
+        for entry in entries:
+            if entry["expires_at"] >= now:
+                # The TTL may have been shortened since the snapshot was taken
+                expires_at = min(entry["expires_at"], now + self.ttl)
+                self.put(entry["key"], entry["is_qa"], EPXCredentials(**entry["credentials"]), expires_at)
+                restored += 1
+        return restored
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+credential_cache = CredentialCache()
+register_metrics("credential_cache", credential_cache.snapshot)
+
+
+def remove_bearer_prefix_case_insensitive(s):
+    prefix = "bearer "
+    if s.lower().startswith(prefix):
+        return s[len(prefix) :]
+    return s
+
+
 def get_api_key_from_http_request(request: Request) -> str:
     """
     Returns the API Key from a given request
     :param request:
     :return:
     """
-    def remove_bearer_prefix_case_insensitive(s):
-        prefix = "bearer "
-        if s.lower().startswith(prefix):
-            return s[len(prefix) :]
-        return s
-
     api_key = remove_bearer_prefix_case_insensitive(
         request.headers.get("Authorization")
     )
@@ -34,6 +124,28 @@ def get_api_key_from_http_request(request: Request) -> str:
     return api_key
 
 
+def hash_api_key(api_key: str) -> str:
+    """
+    Returns a stable, non-reversible identifier for an API key
+    :param api_key:
+    :return:
+    """
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def scheduled_as_caller(handler):
+    """
+    Route decorator making the caller's API key the tenant its upstream calls are scheduled under.
+    """
+    @wraps(handler)
+    async def wrapper(request, *args, **kwargs):
+        authorization = request.headers.get("Authorization")
+        tenant = hash_api_key(remove_bearer_prefix_case_insensitive(authorization)) if authorization else ANONYMOUS_TENANT
+        with tenant_scope(tenant):
+            return await handler(request, *args, **kwargs)
+    return wrapper
+
+
 async def get_credentials_from_api_key(api_key: str, is_qa: bool = False) -> EPXCredentials:
     """
     Authorizes a key against our primary server.
@@ -45,6 +157,14 @@ async def get_credentials_from_api_key(api_key: str, is_qa: bool = False) -> EPX
     :return: bool
     """
 
+    api_key_hash = hash_api_key(api_key)
+    credentials = credential_cache.get(api_key_hash, is_qa)
+    if credentials is not None:
+        note_merchant(credentials.MERCH_NBR, credentials.TERMINAL_NBR)
+        return credentials
+
+    note_passthrough_miss()
+
     data = {
         "auth_key": api_key,
         "qa": is_qa
@@ -52,29 +172,36 @@ async def get_credentials_from_api_key(api_key: str, is_qa: bool = False) -> EPX
     headers = {"Authorization": f"Bearer {api_key}"}
     logger.info(f"Submitting data for authorization: {data}")
 
-    url = 'https://tripleplaypay.com/passthrough'
+    url = passthrough.url("/passthrough")
 
-    # use async ClientSession to POST
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.post(url, json=data) as response:
+    # POST over the pooled session, once the caller's turn for upstream capacity comes up
+    async with upstream_slot():
+        # Leave most of the request's deadline for the processor call which follows
+        timeout = upstream_timeout(PASSTHROUGH_DEADLINE_SHARE)
+        try:
+            async with passthrough.session().post(url, json=data, headers=headers, timeout=timeout) as response:
 
-            if response.status != 200:
-                raise CredentialingError("The passthrough request was not successful.")
+                if response.status != 200:
+                    raise CredentialingError("The passthrough request was not successful.")
 
-            the_json = await response.json()
+                the_json = await response.json()
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(f"Timed out after {timeout.total:.3f}s authorizing against the passthrough")
 
-            is_authorized = the_json.get("authorized", False)
-            if not is_authorized:
-                raise CredentialingError("The merchant is not authorized to perform this action.")
+    is_authorized = the_json.get("authorized", False)
+    if not is_authorized:
+        raise CredentialingError("The merchant is not authorized to perform this action.")
 
-            credentials = EPXCredentials(
-                MERCH_NBR=the_json.get("MERCH_NBR"),
-                TERMINAL_NBR=the_json.get("TERMINAL_NBR"),
-                CUST_NBR=the_json.get("CUST_NBR"),
-                DBA_NBR=the_json.get("DBA_NBR")
-            )
+    credentials = EPXCredentials(
+        MERCH_NBR=the_json.get("MERCH_NBR"),
+        TERMINAL_NBR=the_json.get("TERMINAL_NBR"),
+        CUST_NBR=the_json.get("CUST_NBR"),
+        DBA_NBR=the_json.get("DBA_NBR")
+    )
 
-            if credentials.MERCH_NBR == 0:
-                raise CredentialingError("The merchant exists but is not authorized on EPX.")
+    if credentials.MERCH_NBR == 0:
+        raise CredentialingError("The merchant exists but is not authorized on EPX.")
 
-            return credentials
+    credential_cache.put(api_key_hash, is_qa, credentials)
+    note_merchant(credentials.MERCH_NBR, credentials.TERMINAL_NBR)
+    return credentials
@@ -1,22 +1,67 @@
+import hmac
+import os
 from dataclasses import asdict
 
 from sanic import json, Request, SanicException, Blueprint
+from sanic.exceptions import NotFound
 from sanic.response import JSONResponse
 
+from service.accounting import SORT_KEYS, accounted, heavy_hitters, note_terminal
+from service.admission import Priority, admission_control
+from service.deadline import DeadlineExceeded, TRANSACTION_BUDGET, KEY_INJECTION_BUDGET, with_deadline
 from service.logger import get_logger
+from service.metrics import collect_metrics
 from service.models import TransactionRequest, TerminalRegistryParameters, RemoteKeyInjectionParameters, InitialRemoteKeyInjectionParameters
-from service.authorization import get_api_key_from_http_request, get_credentials_from_api_key
+from service.authorization import get_api_key_from_http_request, get_credentials_from_api_key, hash_api_key, scheduled_as_caller
 from service.cryptography import register_terminal, get_key_for_remote_key_injection, get_remote_key_injection_parameters_from_terminal_id
-from service.environment import is_qa_environment
-from service.json_util import ignore_properties
+from service.environment import TRANSACTION_IS_QA, is_qa_environment
 from service.epx import EPXProcessor
+from service.jobs import JobQueueFull, transaction_jobs
+from service.replay_filter import NonceReplayed, check_nonce
+from service.signatures import VERIFY_TERMINAL_SIGNATURES, TerminalSignatureError, verify_terminal_signature
+from service.terminal_channel import serve_terminal_channel
+from service.transaction_index import transaction_index
+from service.validation import ValidationError, validate_callback_url, validate_headers, validate_request
 
 logger = get_logger()
 
 bp = Blueprint("PointToPoint", url_prefix="/p2pe")
 
+# When set, /p2pe/metrics requires this value as a bearer token
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+@bp.exception(ValidationError)
+async def validation_error(request: Request, exception: ValidationError) -> JSONResponse:
+    """
+    Rejects malformed requests before any upstream call is made.
+
+    :param request: Request
+    :param exception: ValidationError
+    :return: JSONResponse
+    """
+    logger.info(f"Request to {request.path} failed validation: {exception.errors}")
+    return json({"description": "Unprocessable Entity", "errors": exception.errors, "status": 422}, status=422)
+
+
+@bp.exception(DeadlineExceeded)
+async def deadline_exceeded(request: Request, exception: DeadlineExceeded) -> JSONResponse:
+    """
+    Gives a definitive answer once a request runs out of its deadline budget.
+
+    :param request: Request
+    :param exception: DeadlineExceeded
+    :return: JSONResponse
+    """
+    logger.info(f"Request to {request.path} exceeded its deadline: {exception}")
+    return json({"description": "Gateway Timeout", "message": str(exception), "status": 504}, status=504)
+
 
 @bp.post("/transaction")
+@admission_control(Priority.TRANSACTION)
+@with_deadline(TRANSACTION_BUDGET)
+@scheduled_as_caller
+@accounted
 async def transaction(request: Request) -> JSONResponse:
     """
     Using a dedicated request, call EPX as a pass through.
@@ -25,22 +70,46 @@ async def transaction(request: Request) -> JSONResponse:
     :return: JSONResponse
     """
 
-    is_qa = True  # Hardcode to True for now to just use test credentials with EPX
+    is_qa = TRANSACTION_IS_QA
     logger.info(f"Transaction called with the following parameters: {request.json}")
-    request_input = ignore_properties(TransactionRequest, request.json)
+    request_input = validate_request(TransactionRequest, request)
+
+    # RFC 7240: the client would rather poll or be called back than wait on EPX
+    respond_async = "respond-async" in [p.strip().lower() for p in request.headers.get("Prefer", "").split(",")]
+    callback_url = request.headers.get("X-Callback-Url")
+    if callback_url:
+        validate_callback_url(callback_url)
 
     # Authorize the request
     api_key = get_api_key_from_http_request(request)
     try:
         credentials = await get_credentials_from_api_key(api_key, is_qa)
+    except DeadlineExceeded:
+        raise
     except Exception:
         logger.exception("Exception getting credentials from the provided API key")
         raise SanicException("Not authorized to perform this action.", status_code=401)
 
+    if respond_async:
+        try:
+            job = transaction_jobs.submit(
+                hash_api_key(api_key), credentials, request_input, is_qa, callback_url, api_key if callback_url else None
+            )
+        except JobQueueFull as e:
+            raise SanicException(str(e), status_code=503, headers={"Retry-After": "1"}, quiet=True)
+
+        return json(
+            job.to_json(),
+            status=202,
+            headers={"Location": request.app.url_for("PointToPoint.transaction_result", job_id=job.id)},
+        )
+
     try:
         # Send the request to the processor
         processor = EPXProcessor(credentials, is_qa)
         result = await processor.charge(request_input)
+    except DeadlineExceeded:
+        raise
     except Exception:
         logger.exception("Exception while attempting to process")
         raise SanicException("Unable to successfully complete transaction.", status_code=400)
@@ -49,7 +118,73 @@ async def transaction(request: Request) -> JSONResponse:
     return json(asdict(result))
 
 
+@bp.get("/transaction/lookup")
+@with_deadline(TRANSACTION_BUDGET)
+@scheduled_as_caller
+@accounted
+async def transaction_lookup(request: Request) -> JSONResponse:
+    """
+    Finds recent transactions of the caller's merchant, by exactly one of
+    the auth_guid, tran_nbr or terminal_nbr query arguments.
+
+    :param request: Request
+    :return: JSONResponse
+    """
+    validate_headers(request)
+    lookups = {key: request.args.get(key) for key in ("auth_guid", "tran_nbr", "terminal_nbr") if request.args.get(key)}
+    if len(lookups) != 1:
+        raise ValidationError(["Exactly one of auth_guid, tran_nbr or terminal_nbr is required"])
+
+    # Authorize the request, and only ever look at the caller's own merchant
+    api_key = get_api_key_from_http_request(request)
+    try:
+        credentials = await get_credentials_from_api_key(api_key, True)
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        logger.exception("Exception getting credentials from the provided API key")
+        raise SanicException("Not authorized to perform this action.", status_code=401)
+
+    merch_nbr = str(credentials.MERCH_NBR)
+    if "auth_guid" in lookups:
+        entries = transaction_index.by_auth_guid_for(merch_nbr, lookups["auth_guid"])
+    elif "tran_nbr" in lookups:
+        entries = transaction_index.by_tran_nbr_for(merch_nbr, lookups["tran_nbr"])
+    else:
+        entries = transaction_index.by_terminal_for(merch_nbr, lookups["terminal_nbr"])
+
+    return json({
+        "transactions": [
+            {"recorded_at": entry.recorded_at, "response": asdict(entry.response)} for entry in entries
+        ]
+    })
+
+
+@bp.get("/transaction/<job_id:uuid>")
+async def transaction_result(request: Request, job_id) -> JSONResponse:
+    """
+    Returns the status, and once finished the result, of a transaction submitted asynchronously.
+
+    :param request: Request
+    :param job_id: UUID
+    :return: JSONResponse
+    """
+    if not request.headers.get("Authorization"):
+        raise SanicException("Not authorized to perform this action.", status_code=401)
+
+    api_key = get_api_key_from_http_request(request)
+    job = transaction_jobs.get(str(job_id), hash_api_key(api_key))
+    if job is None:
+        raise SanicException("Transaction not found.", status_code=404)
+
+    return json(job.to_json())
+
+
 @bp.post("/register-terminal-for-remote-key-injection")
+@admission_control(Priority.KEY_INJECTION)
+@with_deadline(KEY_INJECTION_BUDGET)
+@scheduled_as_caller
+@accounted
 async def register_terminal_for_rki(request: Request) -> JSONResponse:
     """
     Registers a terminal for IPEK generation.
@@ -60,13 +195,16 @@ async def register_terminal_for_rki(request: Request) -> JSONResponse:
 
     is_qa = is_qa_environment()
     logger.info(f"register_terminal_for_rki called with the following parameters: {request.json}")
-    request_input = ignore_properties(TerminalRegistryParameters, request.json)
+    request_input = validate_request(TerminalRegistryParameters, request)
+    note_terminal(request_input.terminal_id)
 
     # Authorize the request
     api_key = get_api_key_from_http_request(request)
 
     try:
         result = await register_terminal(request_input, api_key, is_qa)
+    except DeadlineExceeded:
+        raise
     except Exception:
         logger.exception("Exception while attempting to register terminal")
         raise SanicException("Unable to successfully complete terminal registration.", status_code=400)
@@ -75,6 +213,10 @@ async def register_terminal_for_rki(request: Request) -> JSONResponse:
 
 
 @bp.post("/get-key-from-registered-terminal-for-remote-key-injection")
+@admission_control(Priority.KEY_INJECTION)
+@with_deadline(KEY_INJECTION_BUDGET)
+@scheduled_as_caller
+@accounted
 async def get_key_from_registered_terminal_for_remote_key_injection(request: Request) -> JSONResponse:
     """
     Returns an IPEK which is encrypted but can be verified.
@@ -85,7 +227,14 @@ async def get_key_from_registered_terminal_for_remote_key_injection(request: Req
 
     is_qa = is_qa_environment()
     logger.info(f"register_terminal_for_rki called with the following parameters: {request.json}")
-    request_input = ignore_properties(InitialRemoteKeyInjectionParameters, request.json)
+    request_input = validate_request(InitialRemoteKeyInjectionParameters, request)
+    note_terminal(request_input.terminal_id)
+
+    # A replayed request is turned away before it costs a terminal lookup and a cryptography call
+    try:
+        check_nonce(request_input.terminal_id, request_input.nonce)
+    except NonceReplayed as e:
+        raise SanicException(str(e), status_code=409, quiet=True)
 
     # Authorize the request
     api_key = get_api_key_from_http_request(request)
@@ -93,14 +242,91 @@ async def get_key_from_registered_terminal_for_remote_key_injection(request: Req
         parameters: RemoteKeyInjectionParameters = await get_remote_key_injection_parameters_from_terminal_id(
             request_input, api_key, is_qa
         )
+    except DeadlineExceeded:
+        raise
     except Exception:
         logger.exception("Exception while formatting remote key injection parameters.")
         raise SanicException("Unable to get key injection parameters from provided terminal.", status_code=400)
 
+    # Turn away forged or corrupted requests before they reach the cryptography service
+    if VERIFY_TERMINAL_SIGNATURES:
+        try:
+            await verify_terminal_signature(parameters)
+        except TerminalSignatureError:
+            logger.exception("Terminal signature failed verification")
+            raise SanicException("Terminal signature could not be verified.", status_code=401)
+
     try:
         result = await get_key_for_remote_key_injection(parameters, is_qa)
+    except DeadlineExceeded:
+        raise
     except Exception:
         logger.exception("Exception while attempting to register terminal")
         raise SanicException("Unable to successfully complete terminal key injection.", status_code=400)
 
     return json(result)
+
+
+@bp.websocket("/ws")
+async def terminal_channel(request: Request, ws) -> None:
+    """
+    Long-lived channel a terminal authenticates on once, then
+    multiplexes transaction and key injection messages over.
+
+    :param request: Request
+    :param ws: WebsocketImplProtocol
+    :return: None
+    """
+    logger.info("Terminal channel opened")
+    await serve_terminal_channel(request, ws)
+
+
+def check_metrics_token(request: Request) -> None:
+    """
+    Turns away callers without the METRICS_TOKEN. Without a token configured
+    the operational routes are not served at all, since they list merchants,
+    terminals, tenant hashes and internal addresses.
+
+    :param request: Request
+    :return: None
+    """
+    if not METRICS_TOKEN:
+        raise NotFound(f"Requested URL {request.path} not found", quiet=True)
+    expected = f"Bearer {METRICS_TOKEN}"
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+        raise SanicException("Not authorized to perform this action.", status_code=401)
+
+
+@bp.get("/metrics")
+async def metrics(request: Request) -> JSONResponse:
+    """
+    Reports operational metrics such as the current admission limit and rejections.
+
+    :param request: Request
+    :return: JSONResponse
+    """
+    check_metrics_token(request)
+    return json(collect_metrics())
+
+
+@bp.get("/admin/heavy-hitters")
+async def admin_heavy_hitters(request: Request) -> JSONResponse:
+    """
+    Reports the tenants, merchants and terminals with the most requests or cost.
+
+    Takes `by` (count, latency_sum, errors, passthrough_misses or epx_latency_sum) and `limit`.
+
+    :param request: Request
+    :return: JSONResponse
+    """
+    check_metrics_token(request)
+
+    by = request.args.get("by", "count")
+    if by not in SORT_KEYS:
+        raise ValidationError([f"by must be one of {', '.join(SORT_KEYS)}"])
+    try:
+        limit = int(request.args.get("limit", "20"))
+    except ValueError:
+        raise ValidationError(["limit must be a whole number"])
+
+    return json(heavy_hitters(max(1, limit), by))
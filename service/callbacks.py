@@ -0,0 +1,125 @@
+"""
+Delivery of asynchronous transaction results to callback URLs.
+
+Callback URLs come from clients, so every connection made for one is
+checked against what the host actually resolves to: loopback,
+link-local, private and otherwise internal addresses are refused at
+connect time, which also covers DNS rebinding. Redirects are not
+followed.
+
+Each callback is signed with an HMAC-SHA256 keyed by the API key that
+submitted the transaction, so the receiver can tell it came from the
+gateway:
+
+    X-Callback-Signature: t=<unix seconds>,v1=<hex HMAC of "<t>.<body>">
+
+A callback is made on behalf of the tenant which submitted the job, and
+within a deadline of CALLBACK_TIMEOUT seconds which covers waiting for an
+upstream slot as well as the post itself.
+"""
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import socket
+import time
+from typing import Any, Dict, List
+from urllib.parse import urlparse
+
+import aiohttp
+from aiohttp.abc import AbstractResolver, ResolveResult
+from aiohttp.resolver import DefaultResolver
+
+from service.deadline import upstream_timeout
+from service.json_util import UUIDEncoder
+from service.logger import get_logger
+from service.scheduling import upstream_slot
+from service.upstreams import Upstream
+from service.validation import is_public_address
+
+logger = get_logger()
+
+CALLBACK_TIMEOUT = float(os.getenv("CALLBACK_TIMEOUT", "10"))
+SIGNATURE_HEADER = "X-Callback-Signature"
+
+
+class CallbackDeliveryError(Exception):
+    """
+    Raised when a callback could not be delivered
+    """
+    pass
+
+
+class PublicAddressResolver(AbstractResolver):
+    """
+    Resolves like aiohttp's default resolver, refusing hosts with any internal address
+    """
+
+    def __init__(self):
+        self.resolver = DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET) -> List[ResolveResult]:
+        hosts = await self.resolver.resolve(host, port, family)
+        for resolved in hosts:
+            if not is_public_address(ipaddress.ip_address(resolved["host"])):
+                # aiohttp turns this into a ClientConnectorError
+                raise OSError(f"Callback host {host} resolves to an internal address")
+        return hosts
+
+    async def close(self) -> None:
+        await self.resolver.close()
+
+
+# Its own pool, so no callback can ever reuse a connection opened to one of our services
+callback_upstream = Upstream("callbacks", "https://callbacks", resolver=PublicAddressResolver)
+
+
+def sign_callback(body: bytes, key: str, timestamp: int) -> str:
+    """
+    Returns the signature header value for a callback body.
+
+    :param body: bytes exactly as sent
+    :param key: str API key the transaction was submitted with
+    :param timestamp: int unix seconds
+    :return: str
+    """
+    digest = hmac.new(key.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+async def deliver_callback(url: str, payload: Dict[str, Any], key: str) -> None:
+    """
+    Posts a signed payload to a callback URL.
+
+    :param url: str validated with validate_callback_url
+    :param payload: Dict[str, Any]
+    :param key: str API key to sign with
+    :return: None
+    """
+    try:
+        # IP literals never reach the resolver
+        if not is_public_address(ipaddress.ip_address(urlparse(url).hostname or "")):
+            raise CallbackDeliveryError(f"Callback URL {url} points at an internal address")
+    except ValueError:
+        pass
+
+    body = json.dumps(payload, cls=UUIDEncoder).encode()
+    headers = {
+        "Content-Type": "application/json",
+        SIGNATURE_HEADER: sign_callback(body, key, int(time.time())),
+    }
+    try:
+        async with upstream_slot():
+            # Taken once the slot is had, so waiting for it counts against the deadline
+            timeout = upstream_timeout()
+            async with callback_upstream.session().post(
+                url, data=body, headers=headers, timeout=timeout, allow_redirects=False
+            ) as response:
+                await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise CallbackDeliveryError(f"Unable to reach callback URL {url}: {e!r}")
+
+    if response.status >= 300:
+        raise CallbackDeliveryError(f"Callback URL {url} answered {response.status}")
@@ -1,11 +1,16 @@
+import asyncio
 import json
+import time
 from typing import Any, Dict, Literal
 
 import aiohttp
 import xmltodict
 
+from service.deadline import DeadlineExceeded, upstream_timeout
 from service.json_util import UUIDEncoder
 from service.logger import get_logger
+from service.scheduling import upstream_slot
+from service.upstreams import Upstream
 
 logger = get_logger()
 
@@ -35,7 +40,9 @@ class CourierRequest:
         fields=None,
         mode: HTTPVerb = None,
         headers=None,
-        is_xml=False
+        is_xml=False,
+        timeout_share: float = 1.0,
+        upstream: Upstream = None
     ):
         """
         Initializes a new instance of the CourierRequest class.
@@ -47,6 +54,8 @@ class CourierRequest:
             mode (str): The HTTP method for the request.
             headers (dict): The headers for the HTTP request.
             is_xml (bool): A flag indicating whether the request is XML.
+            timeout_share (float): The share of the request's remaining deadline this call may use.
+            upstream (Upstream): The upstream whose pooled connections to send over, if any.
         """
         self.errors = []
         self.failures = []
@@ -57,6 +66,13 @@ class CourierRequest:
         self.mode = mode
         self.headers = headers if headers else {}
         self.is_xml = is_xml
+        self.timeout_share = timeout_share
+        self.upstream = upstream
+        # Seconds the last send spent on the network, for callers tracking upstream health
+        self.elapsed = None
+        # Seconds the last send was allowed by the request's deadline, and whether it ran out
+        self.allotted = None
+        self.timed_out = False
 
         if not self.url:
             self.errors.append("No url parameter")
@@ -115,36 +131,68 @@ class CourierRequest:
         if len(self.errors) > 0:
             raise CourierHTTPRequestError("HTTP Request Errors Present", self.errors)
 
-    async def send(self) -> Any | None:
+    async def __read(self, client: aiohttp.ClientSession, request: Dict, timeout: aiohttp.ClientTimeout) -> Any:
         """
-        Sends out the request, handling exceptions along the way.
+        Makes the call on the given session and reads the whole response, freeing the connection.
         """
-        logger.info(f"About to send out request: {self.request}")
+        async with client.request(**request, timeout=timeout) as client_response:
+            # disable MIME type checks on JSON responses for now
+            return (
+                await client_response.text("utf-8")
+                if self.is_xml
+                else await client_response.json(content_type=None)
+            )
 
+    async def __send(self, request: Dict) -> Any:
+        """
+        Makes the HTTP call itself, once the tenant's turn for upstream capacity has come up.
+        """
+        # Raises DeadlineExceeded up front if the request has no time left for this call
+        timeout = upstream_timeout(self.timeout_share)
+        self.allotted = timeout.total
+
+        started = time.monotonic()
         try:
-            connector = aiohttp.TCPConnector()
-            async with aiohttp.ClientSession(connector=connector) as client:
-                client_response = await client.request(**self.request)
-                # disable MIME type checks on JSON responses for now
-                response = (
-                    await client_response.text("utf-8")
-                    if self.is_xml
-                    else await client_response.json(content_type=None)
-                )
+            if self.upstream is not None:
+                response = await self.__read(self.upstream.session(), request, timeout)
+            else:
+                connector = aiohttp.TCPConnector()
+                async with aiohttp.ClientSession(connector=connector, timeout=timeout) as client:
+                    response = await self.__read(client, request, timeout)
+        except asyncio.TimeoutError:
+            """
+            It ran out of the time the request's deadline allowed it
+            """
+            self.timed_out = True
+            logger.exception(f"Timed out after {timeout.total:.3f}s with request: {request}")
+            raise DeadlineExceeded(f"Timed out with request made to: {self.url}")
         except aiohttp.ClientConnectionError:
             """
             It failed specifically to connect to the endpoint that was called
             """
             logger.exception(
-                f"ClientConnectionError thrown with request: {self.request}"
+                f"ClientConnectionError thrown with request: {request}"
             )
             raise CourierHTTPRequestError(f"ClientConnectionError with request made to: {self.url}")
         except aiohttp.ClientError:
             """
             This is here to just catch any other exception which could occur.
             """
-            logger.exception(f"ClientError thrown with request: {self.request}")
+            logger.exception(f"ClientError thrown with request: {request}")
             raise CourierHTTPRequestError(f"ClientError with request made to: {self.url}")
+        finally:
+            self.elapsed = time.monotonic() - started
+
+        return response
+
+    async def send(self) -> Any | None:
+        """
+        Sends out the request, handling exceptions along the way.
+        """
+        logger.info(f"About to send out request: {self.request}")
+
+        async with upstream_slot():
+            response = await self.__send(self.request)
 
         # If it succeeded in the first block
         if response:
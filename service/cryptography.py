@@ -8,6 +8,7 @@ from service.json_util import ignore_properties
 from service.logger import get_logger
 from service.courier import CourierRequest
 from service.models import TerminalRegistryParameters, RemoteKeyInjectionParameters, InitialRemoteKeyInjectionParameters
+from service.upstreams import cryptography_for, ipek_registry_for
 
 
 logger = get_logger()
@@ -28,12 +29,13 @@ async def register_terminal(
     :param is_qa: bool
     :return: Dict[str, Any]
     """
-    url = "http://localhost/api/ipek" if is_qa else "https://tripleplaypay.com/api/ipek"
+    upstream = ipek_registry_for(is_qa)
     courier_request = CourierRequest(
         mode="POST",
-        url=url,
+        url=upstream.url("/api/ipek"),
         body=asdict(terminal_parameters),
         headers={"Authorization": f"Bearer {auth_key}"},
+        upstream=upstream,
     )
     return await courier_request.send()
 
@@ -51,11 +53,12 @@ async def get_key_for_remote_key_injection(
     :param is_qa: bool
     :return: Dict[str, Any]
     """
-    url = "http://localhost:9001/api/ipek" if is_qa else "https://cryptography.tripleplaypay.network/api/ipek"
+    upstream = cryptography_for(is_qa)
     courier_request = CourierRequest(
         mode="POST",
-        url=url,
+        url=upstream.url("/api/ipek"),
         body=asdict(rki_parameters),
+        upstream=upstream,
     )
     return await courier_request.send()
 
@@ -75,16 +78,16 @@ async def get_remote_key_injection_parameters_from_terminal_id(
     :param is_qa: bool
     :return: RemoteKeyInjectionParameters
     """
-    if is_qa:
-        url = f"http://localhost/api/ipek/terminal/{rki_parameters.terminal_id}"
-    else:
-        url = f"https://tripleplaypay.com/api/ipek/terminal/{rki_parameters.terminal_id}"
+    upstream = ipek_registry_for(is_qa)
 
     # Send the request
     courier_request = CourierRequest(
         mode="GET",
-        url=url,
+        url=upstream.url(f"/api/ipek/terminal/{rki_parameters.terminal_id}"),
         headers={"Authorization": f"Bearer {auth_key}"},
+        upstream=upstream,
+        # Leave half the request's deadline for the cryptography service call which follows
+        timeout_share=0.5,
     )
 
     # Get the results
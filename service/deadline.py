@@ -0,0 +1,141 @@
+"""
+End-to-end deadline budgets for requests.
+
+Each request gets a budget, the route's default or less when the
+caller asks for less with the `X-Request-Deadline` header (milliseconds). Every upstream call then
+takes its timeout from what is left of that budget, and calls which
+could not finish in time are not made at all.
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Iterator, Optional
+
+import aiohttp
+
+from service.logger import get_logger
+
+logger = get_logger()
+
+DEADLINE_HEADER = "X-Request-Deadline"
+
+# Default budgets in seconds, per kind of route
+TRANSACTION_BUDGET = float(os.getenv("TRANSACTION_DEADLINE", "30"))
+KEY_INJECTION_BUDGET = float(os.getenv("KEY_INJECTION_DEADLINE", "15"))
+
+# An upstream call is not worth starting with less time than this
+MIN_HOP_BUDGET = float(os.getenv("MIN_UPSTREAM_BUDGET", "0.25"))
+
+# Used for upstream calls made outside of any request
+DEFAULT_UPSTREAM_TIMEOUT = float(os.getenv("DEFAULT_UPSTREAM_TIMEOUT", "30"))
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a request's deadline can't cover its next upstream call
+    """
+    pass
+
+
+class Deadline:
+    """
+    The point in time by which a request has to be answered
+    """
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def timeout(self, share: float = 1.0) -> aiohttp.ClientTimeout:
+        """
+        Returns the timeout for the next upstream call, giving it `share`
+        of the remaining budget and keeping the rest for later calls.
+
+        :param share: float between 0 and 1
+        :return: aiohttp.ClientTimeout
+        """
+        remaining = self.remaining()
+        allotted = remaining * share
+        if remaining < MIN_HOP_BUDGET:
+            raise DeadlineExceeded(f"Only {remaining:.3f}s left of the {self.budget:.3f}s deadline")
+
+        return aiohttp.ClientTimeout(total=max(allotted, MIN_HOP_BUDGET))
+
+
+_current_deadline: ContextVar[Optional[Deadline]] = ContextVar("deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    """
+    Returns the deadline of the current request, if there is one.
+    """
+    return _current_deadline.get()
+
+
+def upstream_timeout(share: float = 1.0) -> aiohttp.ClientTimeout:
+    """
+    Returns the timeout for an upstream call made within the current request.
+
+    :param share: float share of the remaining budget to spend on this call
+    :return: aiohttp.ClientTimeout
+    """
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return aiohttp.ClientTimeout(total=DEFAULT_UPSTREAM_TIMEOUT)
+    return deadline.timeout(share)
+
+
+@contextmanager
+def deadline_scope(budget: float) -> Iterator[Deadline]:
+    """
+    Makes a deadline current for everything awaited within the block.
+
+    :param budget: float seconds
+    """
+    deadline = Deadline(budget)
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def budget_from_header(value: Optional[str], default: float) -> float:
+    """
+    Returns the budget asked for in the deadline header, or the default.
+
+    Callers may only shorten their budget, never raise it past the route's default.
+
+    :param value: Optional[str] milliseconds
+    :param default: float seconds
+    :return: float seconds
+    """
+    if not value:
+        return default
+    try:
+        budget = int(value) / 1000
+    except ValueError:
+        logger.info(f"Ignoring invalid {DEADLINE_HEADER} header: {value}")
+        return default
+    return min(max(budget, 0.0), default)
+
+
+def with_deadline(default_budget: float):
+    """
+    Route decorator running the handler within a deadline budget.
+
+    :param default_budget: float seconds, used when the header is absent
+    """
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request, *args, **kwargs):
+            budget = budget_from_header(request.headers.get(DEADLINE_HEADER), default_budget)
+            with deadline_scope(budget):
+                return await handler(request, *args, **kwargs)
+        return wrapper
+    return decorator
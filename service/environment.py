@@ -6,6 +6,11 @@ from service.logger import get_logger
 
 logger = get_logger()
 
+# Transactions are hardcoded to EPX test credentials and the QA platform
+# for now, whatever IS_QA says. Everything which serves or warms the
+# transaction path must use this rather than is_qa_environment().
+TRANSACTION_IS_QA = True
+
 
 def is_qa_environment() -> bool:
     """
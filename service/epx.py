@@ -4,9 +4,13 @@ from dataclasses import asdict
 import urllib.parse as parse
 import uuid
 from service.logger import get_logger
+from service.accounting import note_epx_call
 from service.courier import CourierRequest
+from service.journal import journal
 from service.json_util import ignore_properties
 from service.models import TransactionRequest, TransactionResponse, EPXCredentials
+from service.processor_endpoints import PROBE_TIMEOUT, processor_endpoints
+from service.transaction_index import transaction_index
 
 logger = get_logger()
 
@@ -24,10 +28,8 @@ class EPXProcessor:
             qa=False,
     ):
         self.qa = qa
-        self.url = "https://secure.epx.com"
+        self.endpoints = processor_endpoints(self.qa)
         self.creds = asdict(epx_credentials)
-        if self.qa:
-            self.url = "https://secure.epxuap.com"
         self.reference = str(uuid.uuid4())
         self.tranid = arrow.now(EPX_TIME_ZONE).format("MMDDHHmmss")
         self.batchid = arrow.now(EPX_TIME_ZONE).format("YYYYMMDD")
@@ -74,24 +76,43 @@ class EPXProcessor:
         :return:
         """
         body.update(self.creds)
-        body = parse.urlencode(body)
-        logger.info(f"Submitting request body to EPX: {body}")
+        encoded_body = parse.urlencode(body)
+        logger.info(f"Submitting request body to EPX: {encoded_body}")
 
+        # Route to the healthiest EPX endpoint we know of
+        endpoint = self.endpoints.choose()
         courier_request = CourierRequest(
             mode=mode,
-            url=self.url,
-            body=body,
+            url=endpoint.url,
+            body=encoded_body,
             headers={"Content-Type": "text/xml"},
             is_xml=True,
+            upstream=endpoint.upstream,
         )
 
-        # Send API Request
-        api_response = await courier_request.send()
-
-        # format the response
-        logger.info(f"Raw api_response from EPX: {api_response}")
-        transaction_response = EPXProcessor.format_response(api_response)
+        succeeded = False
+        try:
+            # Send API Request
+            api_response = await courier_request.send()
+
+            # format the response
+            logger.info(f"Raw api_response from EPX: {api_response}")
+            transaction_response = EPXProcessor.format_response(api_response)
+            succeeded = True
+        finally:
+            # Only calls which went out on the network say anything about the
+            # endpoint, and a timeout only when the endpoint had at least as long
+            # as a probe. Shorter ones are down to the request's own deadline.
+            if courier_request.elapsed is not None:
+                if not (courier_request.timed_out and courier_request.allotted < PROBE_TIMEOUT):
+                    self.endpoints.record(endpoint, courier_request.elapsed, succeeded)
+                note_epx_call(courier_request.elapsed)
 
         # reply with all known properties
         logger.info(f"transaction_response from us: {transaction_response}")
-        return ignore_properties(TransactionResponse, transaction_response)
+        result = ignore_properties(TransactionResponse, transaction_response)
+
+        # Keep the pair for certification, the write happens off the request path
+        journal.record(body, result)
+        transaction_index.record(result)
+        return result
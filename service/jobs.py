@@ -0,0 +1,258 @@
+"""
+Asynchronous transaction submission.
+
+A client which sends `Prefer: respond-async` to /p2pe/transaction gets
+a 202 with a job id as soon as it is authorized. The charge then runs
+on a bounded pool of background workers and the result is kept for
+TRANSACTION_JOB_TTL seconds, to be polled from /p2pe/transaction/{id}
+or posted to the `X-Callback-Url` the client gave.
+
+On shutdown no new jobs are accepted, and the queued and running ones
+are given TRANSACTION_JOB_DRAIN_TIMEOUT seconds to finish, since each
+has already been acknowledged with a 202.
+"""
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional
+
+from service.callbacks import CALLBACK_TIMEOUT, deliver_callback
+from service.deadline import TRANSACTION_BUDGET, deadline_scope
+from service.epx import EPXProcessor
+from service.logger import get_logger
+from service.metrics import register_metrics
+from service.models import EPXCredentials, TransactionRequest
+from service.scheduling import tenant_scope
+
+logger = get_logger()
+
+TRANSACTION_JOB_WORKERS = int(os.getenv("TRANSACTION_JOB_WORKERS", "16"))
+TRANSACTION_JOB_QUEUE_SIZE = int(os.getenv("TRANSACTION_JOB_QUEUE_SIZE", "1000"))
+TRANSACTION_JOB_TTL = float(os.getenv("TRANSACTION_JOB_TTL", "900"))
+# Most finished jobs kept for polling, the oldest results go first beyond it
+TRANSACTION_JOB_MAX_STORED = int(os.getenv("TRANSACTION_JOB_MAX_STORED", "100000"))
+TRANSACTION_JOB_DRAIN_TIMEOUT = float(os.getenv("TRANSACTION_JOB_DRAIN_TIMEOUT", "60"))
+
+PENDING = "pending"
+COMPLETE = "complete"
+FAILED = "failed"
+
+
+class JobQueueFull(Exception):
+    """
+    Raised when no more transactions can be accepted for background processing
+    """
+    pass
+
+
+@dataclass
+class TransactionJob:
+    """
+    A transaction accepted for background processing
+    """
+    id: str
+    owner: str
+    credentials: EPXCredentials
+    request: TransactionRequest
+    is_qa: bool
+    callback_url: Optional[str] = None
+    # API key the callback is signed with, dropped once it has been sent
+    callback_key: Optional[str] = None
+    status: str = PENDING
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    expires_at: float = 0.0
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"id": self.id, "status": self.status, "result": self.result, "error": self.error}
+
+
+class TransactionJobs:
+    """
+    Bounded background worker pool plus a result store with expiry
+    """
+
+    def __init__(
+        self,
+        workers: int = TRANSACTION_JOB_WORKERS,
+        queue_size: int = TRANSACTION_JOB_QUEUE_SIZE,
+        ttl: float = TRANSACTION_JOB_TTL,
+        drain_timeout: float = TRANSACTION_JOB_DRAIN_TIMEOUT,
+        max_stored: int = TRANSACTION_JOB_MAX_STORED,
+    ):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.ttl = ttl
+        self.max_stored = max_stored
+        self.drain_timeout = drain_timeout
+        self.accepting = False
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: List[asyncio.Task] = []
+        self.jobs: Dict[str, TransactionJob] = {}
+        # Ids of finished jobs in the order they expire, every one gets the same TTL from when it finished
+        self.finished: "OrderedDict[str, float]" = OrderedDict()
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        """
+        Starts the workers on the running event loop.
+        """
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self.accepting = True
+
+    async def stop(self) -> None:
+        """
+        Stops taking jobs, lets the queued and running ones finish within the drain timeout, then stops the workers.
+        """
+        self.accepting = False
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                # These were acknowledged but may or may not have been charged, they need reconciling with EPX
+                unfinished = [job.id for job in self.jobs.values() if job.status == PENDING]
+                logger.error(
+                    f"Stopping with {len(unfinished)} transaction jobs unfinished after {self.drain_timeout}s: {unfinished}"
+                )
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(
+        self,
+        owner: str,
+        credentials: EPXCredentials,
+        request: TransactionRequest,
+        is_qa: bool,
+        callback_url: Optional[str] = None,
+        callback_key: Optional[str] = None,
+    ) -> TransactionJob:
+        """
+        Queues a transaction for the workers.
+
+        :param owner: str hash of the API key that submitted it
+        :param credentials: EPXCredentials
+        :param request: TransactionRequest
+        :param is_qa: bool
+        :param callback_url: Optional[str]
+        :param callback_key: Optional[str] API key to sign the callback with
+        :return: TransactionJob
+        """
+        if not self.accepting:
+            raise JobQueueFull("Transactions are no longer being accepted for background processing.")
+
+        self._expire()
+        job = TransactionJob(
+            id=str(uuid.uuid4()),
+            owner=owner,
+            credentials=credentials,
+            request=request,
+            is_qa=is_qa,
+            callback_url=callback_url,
+            callback_key=callback_key,
+            expires_at=time.monotonic() + self.ttl,
+        )
+
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFull("Too many transactions are waiting to be processed.")
+
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str, owner: str) -> Optional[TransactionJob]:
+        """
+        Returns a job if it exists, has not expired and belongs to the owner.
+
+        :param job_id: str
+        :param owner: str
+        :return: Optional[TransactionJob]
+        """
+        self._expire()
+        job = self.jobs.get(job_id)
+        if job is None or job.owner != owner:
+            return None
+        return job
+
+    def _expire(self) -> None:
+        # Only the head can have expired, so this stops at the first job that has not
+        now = time.monotonic()
+        while self.finished:
+            job_id, expires_at = next(iter(self.finished.items()))
+            if expires_at >= now:
+                break
+            self.finished.popitem(last=False)
+            self.jobs.pop(job_id, None)
+
+    def _finish(self, job: TransactionJob) -> None:
+        job.expires_at = time.monotonic() + self.ttl
+        self.finished[job.id] = job.expires_at
+        while len(self.finished) > self.max_stored:
+            job_id, _ = self.finished.popitem(last=False)
+            self.jobs.pop(job_id, None)
+
+    async def _work(self) -> None:
+        while True:
+            job = await self.queue.get()
+            self.busy += 1
+            try:
+                await self._process(job)
+            finally:
+                self.busy -= 1
+                self.queue.task_done()
+
+    async def _process(self, job: TransactionJob) -> None:
+        try:
+            with deadline_scope(TRANSACTION_BUDGET), tenant_scope(job.owner):
+                processor = EPXProcessor(job.credentials, job.is_qa)
+                result = await processor.charge(job.request)
+            job.result = asdict(result)
+            job.status = COMPLETE
+            self.completed += 1
+        except Exception:
+            logger.exception(f"Exception while processing transaction job {job.id}")
+            job.error = "Unable to successfully complete transaction."
+            job.status = FAILED
+            self.failed += 1
+
+        # Keep the result for the full TTL from when it was ready
+        self._finish(job)
+        # Card data is no longer needed once the charge has been made
+        job.request = None
+
+        if job.callback_url:
+            await self._callback(job)
+
+    @staticmethod
+    async def _callback(job: TransactionJob) -> None:
+        try:
+            # Scheduled as the submitting tenant, with a deadline of its own rather than what the charge left
+            with deadline_scope(CALLBACK_TIMEOUT), tenant_scope(job.owner):
+                await deliver_callback(job.callback_url, job.to_json(), job.callback_key)
+        except Exception:
+            logger.exception(f"Unable to deliver callback for transaction job {job.id}")
+        finally:
+            job.callback_key = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "busy": self.busy,
+            "workers": len(self.tasks),
+            "stored": len(self.jobs),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+transaction_jobs = TransactionJobs()
+register_metrics("transaction_jobs", transaction_jobs.snapshot)
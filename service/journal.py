@@ -0,0 +1,233 @@
+"""
+Append-only journal of the requests sent to EPX and their responses.
+
+EPX certification needs the request and response of every transaction.
+Rather than relying on stdout logs, each redacted request body and
+decoded TransactionResponse is appended to a binary journal.
+
+The request path only pushes onto a queue. A background thread writes
+whatever has queued up as one batch and fsyncs once per batch
+(group commit), rotating to a new segment file once one grows past
+JOURNAL_SEGMENT_SIZE, or after a commit fails part way.
+
+The segment format is in service/journal_format.py. Segments can be
+exported back into certification style text with:
+    python service/journal_export.py <directory> [--output file]
+"""
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from service.journal_format import MAGIC, RECORD_HEADER
+from service.logger import get_logger
+from service.metrics import register_metrics
+from service.models import TransactionResponse
+
+logger = get_logger()
+
+# Request fields which never go to disk in full
+REDACTED_FIELDS = ("TRACK_DATA", "EMV_DATA", "PIN_BLK", "MAC", "CARD_ID")
+
+JOURNAL_DIRECTORY = os.getenv("JOURNAL_DIRECTORY")
+JOURNAL_SEGMENT_SIZE = int(os.getenv("JOURNAL_SEGMENT_SIZE", str(64 * 1024 * 1024)))
+JOURNAL_BATCH_SIZE = int(os.getenv("JOURNAL_BATCH_SIZE", "256"))
+# Seconds the writer waits for more records before committing a batch
+JOURNAL_COMMIT_INTERVAL = float(os.getenv("JOURNAL_COMMIT_INTERVAL", "0.005"))
+JOURNAL_QUEUE_SIZE = int(os.getenv("JOURNAL_QUEUE_SIZE", "10000"))
+
+_STOP = object()
+
+
+def redact(value: Any) -> str:
+    """
+    Keeps just enough of a sensitive value to tell records apart.
+    """
+    value = str(value)
+    if len(value) <= 8:
+        return "*" * len(value)
+    return f"{value[:4]}{'*' * (len(value) - 8)}{value[-4:]}"
+
+
+def redact_request(body: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Returns a copy of an EPX request body with sensitive fields masked.
+
+    :param body: Dict[str, Any]
+    :return: Dict[str, Any]
+    """
+    return {
+        key: redact(value) if key in REDACTED_FIELDS and value is not None else value
+        for key, value in body.items()
+    }
+
+
+class TransactionJournal:
+    """
+    Background writer for the journal segments
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str],
+        segment_size: int = JOURNAL_SEGMENT_SIZE,
+        batch_size: int = JOURNAL_BATCH_SIZE,
+        commit_interval: float = JOURNAL_COMMIT_INTERVAL,
+        queue_size: int = JOURNAL_QUEUE_SIZE,
+    ):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+
+        self.queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self.thread: Optional[threading.Thread] = None
+        self.segment = None
+        self.segment_number = 0
+        self.segment_prefix = f"journal-{int(time.time())}-{os.getpid()}"
+
+        self.recorded = 0
+        self.dropped = 0
+        self.committed = 0
+        self.commits = 0
+        self.failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def start(self) -> None:
+        """
+        Starts the writer thread, if journaling is enabled.
+        """
+        if not self.enabled or self.thread is not None:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name="transaction-journal", daemon=True)
+        self.thread.start()
+        logger.info(f"Transaction journal writing to {self.directory}")
+
+    def stop(self) -> None:
+        """
+        Commits everything queued so far and stops the writer thread.
+        """
+        if self.thread is None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+
+    def record(self, request_body: Dict[str, Any], response: TransactionResponse) -> None:
+        """
+        Queues a request and response pair for the journal. Never blocks.
+
+        :param request_body: Dict[str, Any] as sent to EPX
+        :param response: TransactionResponse
+        :return: None
+        """
+        if not self.enabled:
+            return
+
+        self.start()
+        try:
+            self.queue.put_nowait((time.time(), redact_request(request_body), response))
+            self.recorded += 1
+        except queue.Full:
+            self.dropped += 1
+            logger.error("Transaction journal queue is full, dropping record")
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                try:
+                    self._commit(batch)
+                except OSError:
+                    logger.exception(f"Unable to commit {len(batch)} journal records")
+                    self.failed += len(batch)
+                    # A partly written record would hide every record committed after it, so start a new segment
+                    self._close_segment()
+
+        self._close_segment()
+
+    def _next_batch(self) -> Tuple[List[Tuple], bool]:
+        """
+        Waits for a record, then gathers whatever else arrives within the commit interval.
+        """
+        item = self.queue.get()
+        if item is _STOP:
+            return [], True
+
+        batch = [item]
+        deadline = time.monotonic() + self.commit_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _commit(self, batch: List[Tuple]) -> None:
+        if self.segment is None or self.segment.tell() >= self.segment_size:
+            self._rotate()
+
+        data = bytearray()
+        for timestamp, request_body, response in batch:
+            payload = json.dumps(
+                {"request": request_body, "response": asdict(response)},
+                separators=(",", ":"),
+            ).encode()
+            data += RECORD_HEADER.pack(len(payload), zlib.crc32(payload), int(timestamp * 1_000_000))
+            data += payload
+
+        self.segment.write(data)
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+
+        self.committed += len(batch)
+        self.commits += 1
+
+    def _close_segment(self) -> None:
+        if self.segment is None:
+            return
+        try:
+            self.segment.close()
+        except OSError:
+            logger.exception("Unable to close the transaction journal segment")
+        self.segment = None
+
+    def _rotate(self) -> None:
+        self._close_segment()
+
+        self.segment_number += 1
+        path = os.path.join(self.directory, f"{self.segment_prefix}-{self.segment_number:06d}.seg")
+        self.segment = open(path, "ab")
+        if self.segment.tell() == 0:
+            self.segment.write(MAGIC)
+        logger.info(f"Transaction journal rotated to {path}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "committed": self.committed,
+            "commits": self.commits,
+            "failed": self.failed,
+            "queued": self.queue.qsize(),
+            "segment": self.segment_number,
+        }
+
+
+journal = TransactionJournal(JOURNAL_DIRECTORY)
+register_metrics("journal", journal.snapshot)
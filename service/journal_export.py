@@ -0,0 +1,27 @@
+"""
+Exports transaction journal segments as certification style text.
+
+Run it as a script, not as a module of the service package, so that
+only the journal format is loaded and not the gateway itself:
+
+    python service/journal_export.py /path/to/journal --output certification.txt
+"""
+import argparse
+import sys
+
+# Run by path, this directory is first on sys.path and the format module
+# is imported on its own, without service/__init__ and the Sanic app
+from journal_format import export_certification
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export transaction journal segments as certification style text")
+    parser.add_argument("directory")
+    parser.add_argument("--output", help="File to write to, stdout by default")
+    arguments = parser.parse_args()
+
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            count = export_certification(arguments.directory, f)
+    else:
+        count = export_certification(arguments.directory, sys.stdout)
+    print(f"Exported {count} transactions", file=sys.stderr)
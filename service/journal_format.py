@@ -0,0 +1,73 @@
+"""
+On-disk format of the transaction journal, and reading it back.
+
+Segment layout:
+    8 byte magic, then records of
+    <payload length: u32><crc32 of payload: u32><timestamp in µs: i64><JSON payload>
+
+Only the standard library is imported here, nothing else from the
+service package, so service/journal_export.py can read segments without
+loading the gateway.
+"""
+import json
+import logging
+import os
+import struct
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Tuple
+from urllib import parse
+
+# The gateway's AppLogger when loaded by it, Python's last resort handler on stderr otherwise
+logger = logging.getLogger("AppLogger")
+
+MAGIC = b"P2PEJRN1"
+RECORD_HEADER = struct.Struct("<IIq")
+
+
+def read_segment(path: str) -> Iterator[Tuple[float, Dict[str, Any]]]:
+    """
+    Yields (timestamp, record) from a segment, stopping at a torn or corrupt tail.
+
+    :param path: str
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a journal segment")
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, crc, timestamp = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                logger.error(f"Journal segment {path} ends in a partial or corrupt record")
+                return
+            yield timestamp / 1_000_000, json.loads(payload)
+
+
+def export_certification(directory: str, output) -> int:
+    """
+    Writes every journaled transaction in the directory as certification style text.
+
+    :param directory: str
+    :param output: file-like object
+    :return: int number of transactions written
+    """
+    records = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".seg"):
+            records.extend(read_segment(os.path.join(directory, name)))
+    records.sort(key=lambda record: record[0])
+
+    separator = "-" * 59
+    for timestamp, record in records:
+        request_body = record["request"]
+        when = datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+        title = f"{request_body.get('TRAN_TYPE')} Transaction {request_body.get('TRAN_NBR')} ({when})"
+        output.write(f"{separator}\n{title}\n{separator}\n\n")
+        output.write(f"Request:\n\n{parse.urlencode(request_body, safe='*')}\n\n")
+        output.write(f"Response:\n\n{json.dumps(record['response'], indent=4)}\n\n")
+
+    return len(records)
@@ -0,0 +1,127 @@
+"""
+Event loop lag monitor and blocking call detector.
+
+Anything synchronous on the event loop (file I/O, logging config, large
+XML parses, log writes to stdout) holds up every request in flight. The
+monitor sleeps for LOOP_LAG_INTERVAL seconds at a time and records how
+much later than asked it woke up, which is how long the loop was busy
+elsewhere. The lags are reported as a histogram at /p2pe/metrics.
+
+Set LOOP_WATCHDOG_THRESHOLD (in seconds) to also run a watchdog thread.
+When the loop has not come round for longer than the threshold, it logs
+the stack the loop thread is stuck in, once per stall, so the blocking
+call can be found by name rather than inferred from p99.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional
+
+from service.logger import get_logger
+from service.metrics import register_metrics
+
+logger = get_logger()
+
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+# Off unless set, sampling stacks is for tracking a regression down
+LOOP_WATCHDOG_THRESHOLD = float(os.getenv("LOOP_WATCHDOG_THRESHOLD", "0"))
+
+# Upper bounds of the histogram buckets, in milliseconds
+LAG_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class LoopLagMonitor:
+    """
+    Samples the event loop's scheduling delay into a histogram
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, watchdog_threshold: float = LOOP_WATCHDOG_THRESHOLD):
+        self.interval = interval
+        self.watchdog_threshold = watchdog_threshold
+        # One count per bucket, the last for anything above the largest bound
+        self.buckets: List[int] = [0] * (len(LAG_BUCKETS) + 1)
+        self.samples = 0
+        self.lag_sum = 0.0
+        self.lag_max = 0.0
+        self.stalls = 0
+
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.watchdog: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+
+    def observe(self, lag: float) -> None:
+        self.buckets[bisect_left(LAG_BUCKETS, lag * 1000)] += 1
+        self.samples += 1
+        self.lag_sum += lag
+        self.lag_max = max(self.lag_max, lag)
+
+    async def run(self) -> None:
+        """
+        Samples the loop's lag forever, starting the watchdog if it is enabled.
+        """
+        self.loop_thread_id = threading.get_ident()
+        self.start_watchdog()
+
+        # Beat often enough that a healthy loop never looks stalled to the watchdog
+        interval = min(self.interval, self.watchdog_threshold / 4) if self.watchdog_threshold > 0 else self.interval
+        try:
+            while True:
+                expected = time.monotonic() + interval
+                await asyncio.sleep(interval)
+                now = time.monotonic()
+                self.heartbeat = now
+                self.observe(max(0.0, now - expected))
+        finally:
+            self.stop_watchdog()
+
+    def start_watchdog(self) -> None:
+        if self.watchdog_threshold <= 0 or self.watchdog is not None:
+            return
+        self.stopping.clear()
+        self.heartbeat = time.monotonic()
+        self.watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.watchdog.start()
+        logger.info(f"Loop watchdog logging stacks of stalls over {self.watchdog_threshold}s")
+
+    def stop_watchdog(self) -> None:
+        if self.watchdog is None:
+            return
+        self.stopping.set()
+        self.watchdog.join()
+        self.watchdog = None
+
+    def _watch(self) -> None:
+        reported = None
+        while not self.stopping.wait(self.watchdog_threshold / 4):
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat
+            if stalled < self.watchdog_threshold or heartbeat == reported:
+                continue
+
+            # Report each stall once, however long it goes on
+            reported = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "unavailable"
+            logger.error(f"Event loop blocked for {stalled:.3f}s so far, loop thread is at:\n{stack}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        histogram = {f"le_{bound}ms": count for bound, count in zip(LAG_BUCKETS, self.buckets)}
+        histogram[f"gt_{LAG_BUCKETS[-1]}ms"] = self.buckets[-1]
+        return {
+            "samples": self.samples,
+            "mean_ms": round(self.lag_sum / self.samples * 1000, 3) if self.samples else 0.0,
+            "max_ms": round(self.lag_max * 1000, 3),
+            "histogram": histogram,
+            "watchdog": self.watchdog is not None,
+            "stalls": self.stalls,
+        }
+
+
+loop_monitor = LoopLagMonitor()
+register_metrics("loop_lag", loop_monitor.snapshot)
@@ -0,0 +1,31 @@
+"""
+Collects operational metrics from the modules which keep them.
+
+Modules register a callable returning a JSON serializable snapshot
+under a name, and the /p2pe/metrics route reports all of them.
+"""
+from typing import Any, Callable, Dict
+
+MetricsSource = Callable[[], Dict[str, Any]]
+
+_sources: Dict[str, MetricsSource] = {}
+
+
+def register_metrics(name: str, source: MetricsSource) -> None:
+    """
+    Registers a metrics snapshot under the given name.
+
+    :param name: str
+    :param source: MetricsSource
+    :return: None
+    """
+    _sources[name] = source
+
+
+def collect_metrics() -> Dict[str, Any]:
+    """
+    Returns the current snapshot of every registered source.
+
+    :return: Dict[str, Any]
+    """
+    return {name: source() for name, source in _sources.items()}
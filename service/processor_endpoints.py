@@ -0,0 +1,211 @@
+"""
+Latency-aware routing across EPX endpoints.
+
+Several EPX hosts or regions can be listed with EPX_ENDPOINTS (and
+EPX_QA_ENDPOINTS for the test platform), comma separated. Each charge
+goes to the healthy endpoint with the lowest score, where the score is
+its EWMA latency inflated by its EWMA error rate.
+
+An endpoint which fails EPX_EJECTION_FAILURES times in a row is ejected
+for a while, longer each time it happens again. A background task
+probes every endpoint periodically, which keeps the latency of idle
+endpoints current and brings ejected ones back once they answer. A
+failed probe keeps an ejected endpoint out for another spell.
+
+A charge which times out is only held against the endpoint when it was
+allowed at least EPX_PROBE_TIMEOUT. A caller sending a short deadline, or
+a request whose budget was mostly spent before the charge, must not get a
+healthy endpoint ejected.
+"""
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from service.logger import get_logger
+from service.metrics import register_metrics
+from service.upstreams import Upstream
+
+logger = get_logger()
+
+EPX_URL = "https://secure.epx.com"
+EPX_QA_URL = "https://secure.epxuap.com"
+
+EWMA_ALPHA = float(os.getenv("EPX_EWMA_ALPHA", "0.2"))
+EJECTION_FAILURES = int(os.getenv("EPX_EJECTION_FAILURES", "3"))
+EJECTION_TIME = float(os.getenv("EPX_EJECTION_TIME", "30"))
+MAX_EJECTION_TIME = float(os.getenv("EPX_MAX_EJECTION_TIME", "300"))
+# Never eject more than this share of the endpoints at once
+MAX_EJECTED_SHARE = float(os.getenv("EPX_MAX_EJECTED_SHARE", "0.5"))
+PROBE_INTERVAL = float(os.getenv("EPX_PROBE_INTERVAL", "10"))
+PROBE_TIMEOUT = float(os.getenv("EPX_PROBE_TIMEOUT", "5"))
+# How heavily the error rate weighs against an endpoint's latency
+ERROR_PENALTY = 10.0
+
+
+class ProcessorEndpoint:
+    """
+    One EPX endpoint and what we have observed of it
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        # Charges go over a kept-alive pool of connections to the endpoint
+        self.upstream = Upstream(f"epx {url}", url)
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until > time.monotonic()
+
+    @property
+    def score(self) -> float:
+        if self.latency is not None:
+            latency = self.latency
+        elif self.failures:
+            # Never answered but has failed, as bad as a probe that times out
+            latency = PROBE_TIMEOUT
+        else:
+            # Endpoints we know nothing about yet get tried first
+            latency = 0.0
+        return latency * (1 + ERROR_PENALTY * self.error_rate)
+
+    def observe(self, latency: float, succeeded: bool) -> None:
+        self.requests += 1
+        if succeeded:
+            self.latency = latency if self.latency is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency
+            self.error_rate = (1 - EWMA_ALPHA) * self.error_rate
+            self.consecutive_failures = 0
+        else:
+            self.failures += 1
+            self.error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.error_rate
+            self.consecutive_failures += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "latency": round(self.latency, 4) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "ejected": self.ejected,
+            "ejections": self.ejections,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+class ProcessorEndpointRegistry:
+    """
+    The EPX endpoints for one platform, picked by observed latency and errors
+    """
+
+    def __init__(self, urls: List[str]):
+        self.endpoints = [ProcessorEndpoint(url) for url in urls]
+
+    @classmethod
+    def from_environment(cls, variable: str, default: str) -> "ProcessorEndpointRegistry":
+        urls = [url.strip().rstrip("/") for url in os.getenv(variable, default).split(",") if url.strip()]
+        return cls(urls)
+
+    def choose(self) -> ProcessorEndpoint:
+        """
+        Returns the best healthy endpoint, or the one due back soonest if all are ejected.
+
+        :return: ProcessorEndpoint
+        """
+        healthy = [endpoint for endpoint in self.endpoints if not endpoint.ejected]
+        if not healthy:
+            return min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)
+        return min(healthy, key=lambda endpoint: endpoint.score)
+
+    def record(self, endpoint: ProcessorEndpoint, latency: float, succeeded: bool) -> None:
+        """
+        Feeds a call's outcome back, ejecting the endpoint if it keeps failing.
+
+        :param endpoint: ProcessorEndpoint
+        :param latency: float seconds
+        :param succeeded: bool
+        :return: None
+        """
+        endpoint.observe(latency, succeeded)
+        if endpoint.consecutive_failures < EJECTION_FAILURES:
+            return
+
+        if endpoint.ejected:
+            # Still failing, keep it out for another spell rather than letting it lapse
+            endpoint.ejected_until = time.monotonic() + min(MAX_EJECTION_TIME, EJECTION_TIME * endpoint.ejections)
+            return
+
+        ejected = sum(1 for other in self.endpoints if other.ejected)
+        if ejected + 1 > MAX_EJECTED_SHARE * len(self.endpoints):
+            return
+
+        endpoint.ejections += 1
+        ejection_time = min(MAX_EJECTION_TIME, EJECTION_TIME * endpoint.ejections)
+        endpoint.ejected_until = time.monotonic() + ejection_time
+        logger.error(f"Ejecting EPX endpoint {endpoint.url} for {ejection_time:.0f}s after {endpoint.consecutive_failures} failures")
+
+    async def probe(self, session: aiohttp.ClientSession) -> None:
+        """
+        Checks every endpoint once; any HTTP answer counts as reachable.
+        """
+        async def probe_endpoint(endpoint: ProcessorEndpoint) -> None:
+            start = time.monotonic()
+            try:
+                async with session.get(endpoint.url) as response:
+                    await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self.record(endpoint, time.monotonic() - start, False)
+                return
+
+            endpoint.observe(time.monotonic() - start, True)
+            if endpoint.ejected:
+                endpoint.ejected_until = 0.0
+                logger.info(f"EPX endpoint {endpoint.url} answered its probe and is back in rotation")
+
+        await asyncio.gather(*(probe_endpoint(endpoint) for endpoint in self.endpoints))
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [endpoint.snapshot() for endpoint in self.endpoints]
+
+
+production_endpoints = ProcessorEndpointRegistry.from_environment("EPX_ENDPOINTS", EPX_URL)
+qa_endpoints = ProcessorEndpointRegistry.from_environment("EPX_QA_ENDPOINTS", EPX_QA_URL)
+
+register_metrics("epx_endpoints", lambda: {
+    "production": production_endpoints.snapshot(),
+    "qa": qa_endpoints.snapshot(),
+})
+
+
+def processor_endpoints(is_qa: bool) -> ProcessorEndpointRegistry:
+    """
+    Returns the endpoint registry for the platform.
+
+    :param is_qa: bool
+    :return: ProcessorEndpointRegistry
+    """
+    return qa_endpoints if is_qa else production_endpoints
+
+
+async def probe_processor_endpoints() -> None:
+    """
+    Probes the endpoints of every platform with more than one, forever.
+    """
+    registries = [registry for registry in (production_endpoints, qa_endpoints) if len(registry.endpoints) > 1]
+    if not registries:
+        return
+
+    timeout = aiohttp.ClientTimeout(total=PROBE_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        while True:
+            for registry in registries:
+                await registry.probe(session)
+            await asyncio.sleep(PROBE_INTERVAL)
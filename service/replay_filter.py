@@ -0,0 +1,151 @@
+"""
+Rejects replayed key injection requests before any upstream work.
+
+Every (terminal_id, nonce) a key request arrives with is remembered for
+NONCE_WINDOW seconds, in rotating Bloom filters: the current generation
+takes new nonces, and once it is a window old the oldest generation is
+dropped and an empty one started. A nonce is a replay if any generation
+has it, so it is remembered for at least NONCE_GENERATIONS - 1 windows
+and at most NONCE_GENERATIONS. Checks are a fixed number of bit lookups,
+and memory is fixed by NONCE_FILTER_CAPACITY (nonces expected per window)
+and NONCE_FILTER_ERROR_RATE, whatever the traffic.
+
+A false positive turns away a fresh request at most NONCE_FILTER_ERROR_RATE
+of the time, and the terminal simply retries with a new nonce. That bound
+only holds while no generation takes more than NONCE_FILTER_CAPACITY
+nonces, so a generation which fills up is rotated out early. Under a
+flood, nonces are then remembered for less than the window; the
+early_rotations metric counts how often that happened. Each worker keeps
+its own filter.
+"""
+import hashlib
+import math
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterator
+
+from service.metrics import register_metrics
+
+NONCE_REPLAY_FILTER = os.getenv("NONCE_REPLAY_FILTER", "True").lower() == "true"
+NONCE_WINDOW = float(os.getenv("NONCE_WINDOW", "300"))
+NONCE_GENERATIONS = int(os.getenv("NONCE_GENERATIONS", "2"))
+NONCE_FILTER_CAPACITY = int(os.getenv("NONCE_FILTER_CAPACITY", "100000"))
+NONCE_FILTER_ERROR_RATE = float(os.getenv("NONCE_FILTER_ERROR_RATE", "0.000001"))
+
+
+class NonceReplayed(Exception):
+    """
+    Raised when a terminal sends a nonce it has already used
+    """
+    pass
+
+
+class BloomFilter:
+    """
+    Fixed size Bloom filter over a bytearray
+    """
+
+    def __init__(self, bits: int, hashes: int):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray((bits + 7) // 8)
+        self.created_at = time.monotonic()
+        self.added = 0
+
+    def positions(self, digest: bytes) -> Iterator[int]:
+        # Double hashing, two 64 bit halves of one digest give every position
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.bits
+
+    def __contains__(self, digest: bytes) -> bool:
+        return all(self.array[position >> 3] & (1 << (position & 7)) for position in self.positions(digest))
+
+    def add(self, digest: bytes) -> None:
+        for position in self.positions(digest):
+            self.array[position >> 3] |= 1 << (position & 7)
+        self.added += 1
+
+
+class NonceReplayFilter:
+    """
+    Time windowed replay filter keyed by (terminal_id, nonce)
+    """
+
+    def __init__(
+        self,
+        window: float = NONCE_WINDOW,
+        generations: int = NONCE_GENERATIONS,
+        capacity: int = NONCE_FILTER_CAPACITY,
+        error_rate: float = NONCE_FILTER_ERROR_RATE,
+    ):
+        self.window = window
+        self.capacity = capacity
+        # Every generation is checked, so their false positive rates add up
+        per_generation_error = error_rate / generations
+        self.bits = math.ceil(-capacity * math.log(per_generation_error) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.generations: Deque[BloomFilter] = deque(
+            (BloomFilter(self.bits, self.hashes) for _ in range(generations)), maxlen=generations
+        )
+        self.checked = 0
+        self.rejected = 0
+        self.early_rotations = 0
+
+    @staticmethod
+    def digest(terminal_id: str, nonce: str) -> bytes:
+        return hashlib.blake2b(f"{terminal_id}\0{nonce}".encode(), digest_size=16).digest()
+
+    def _rotate(self) -> None:
+        windows = int((time.monotonic() - self.generations[-1].created_at) // self.window)
+        # The deque is bounded, so each new generation drops the oldest one
+        for _ in range(min(windows, self.generations.maxlen)):
+            self.generations.append(BloomFilter(self.bits, self.hashes))
+        # A fuller generation would go over the error rate it was sized for
+        if self.generations[-1].added >= self.capacity:
+            self.early_rotations += 1
+            self.generations.append(BloomFilter(self.bits, self.hashes))
+
+    def check(self, terminal_id: str, nonce: str) -> None:
+        """
+        Remembers the nonce, raising NonceReplayed if it was seen within the window.
+
+        :param terminal_id: str
+        :param nonce: str
+        :return: None
+        """
+        self._rotate()
+        self.checked += 1
+        digest = self.digest(terminal_id, nonce)
+        if any(digest in generation for generation in self.generations):
+            self.rejected += 1
+            raise NonceReplayed(f"Nonce has already been used by terminal {terminal_id}")
+        self.generations[-1].add(digest)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": NONCE_REPLAY_FILTER,
+            "checked": self.checked,
+            "rejected": self.rejected,
+            "bytes": sum(len(generation.array) for generation in self.generations),
+            "current_generation_added": self.generations[-1].added,
+            "early_rotations": self.early_rotations,
+        }
+
+
+nonce_filter = NonceReplayFilter()
+register_metrics("nonce_filter", nonce_filter.snapshot)
+
+
+def check_nonce(terminal_id: str, nonce: str) -> None:
+    """
+    Raises NonceReplayed for a replayed (terminal_id, nonce), when the filter is enabled.
+
+    :param terminal_id: str
+    :param nonce: str
+    :return: None
+    """
+    if NONCE_REPLAY_FILTER:
+        nonce_filter.check(terminal_id, nonce)
@@ -0,0 +1,281 @@
+"""
+Per-tenant fair scheduling of upstream capacity.
+
+Every upstream call made on behalf of a tenant (an API key) goes through
+the scheduler, so a single merchant replaying a batch only slows itself
+down:
+
+1. When TENANT_RATE is set, each tenant has a token bucket refilling at
+   TENANT_RATE times its weight, holding up to its burst allowance. A
+   tenant which runs dry waits for its own tokens without holding anyone
+   else up. Unset, tenants are not rate limited and only the queue below
+   shares out capacity.
+2. At most UPSTREAM_CONCURRENCY calls are in flight at once. When they
+   are all taken, waiting calls are granted in weighted fair queuing
+   order: each gets a virtual finish tag of max(virtual time, tenant's
+   last tag) + 1 / weight, and the smallest tag goes next.
+
+Tenants are identified by the hash of their API key. Weights and bursts
+can be set per tenant with TENANT_WEIGHTS and TENANT_BURSTS, as
+comma separated `<api key hash>=<value>` pairs.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from service.admission import note_upstream_call
+from service.deadline import DeadlineExceeded, current_deadline
+from service.logger import get_logger
+from service.metrics import register_metrics
+
+logger = get_logger()
+
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "64"))
+# Calls per second per tenant, 0 (the default) for no limit
+TENANT_RATE = float(os.getenv("TENANT_RATE", "0"))
+TENANT_BURST = float(os.getenv("TENANT_BURST", "100"))
+# Beyond this many tenants the least recently used ones without calls in progress are forgotten
+MAX_TENANTS = int(os.getenv("MAX_TENANTS", "10000"))
+
+ANONYMOUS_TENANT = "anonymous"
+
+
+def _parse_overrides(value: str) -> Dict[str, float]:
+    overrides = {}
+    for pair in value.split(","):
+        if "=" in pair:
+            tenant, amount = pair.split("=", 1)
+            overrides[tenant.strip()] = float(amount)
+    return overrides
+
+
+class Tenant:
+    """
+    Scheduling state of one tenant
+    """
+
+    def __init__(self, name: str, weight: float, rate: float, burst: float):
+        self.name = name
+        self.weight = weight
+        self.rate = rate * weight
+        self.burst = burst
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        self.last_finish = 0.0
+
+        self.in_flight = 0
+        self.waiting = 0
+        self.granted = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+
+    def take_token(self) -> float:
+        """
+        Takes a token, returning how long to wait for it first (0 if none).
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    @property
+    def busy(self) -> bool:
+        return bool(self.in_flight or self.waiting)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "weight": self.weight,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "granted": self.granted,
+            "throttled": self.throttled,
+            "wait_time": round(self.wait_time, 3),
+        }
+
+
+class FairScheduler:
+    """
+    Token buckets per tenant in front of a weighted fair queue for upstream slots
+    """
+
+    def __init__(
+        self,
+        capacity: int = UPSTREAM_CONCURRENCY,
+        rate: float = TENANT_RATE,
+        burst: float = TENANT_BURST,
+        weights: Optional[Dict[str, float]] = None,
+        bursts: Optional[Dict[str, float]] = None,
+        max_tenants: int = MAX_TENANTS,
+    ):
+        self.capacity = capacity
+        self.rate = rate
+        self.burst = burst
+        self.weights = weights or {}
+        self.bursts = bursts or {}
+        self.max_tenants = max_tenants
+
+        # Least recently used first
+        self.tenants: "OrderedDict[str, Tenant]" = OrderedDict()
+        self.forgotten = 0
+        self.in_use = 0
+        self.virtual_time = 0.0
+        self.queue: List[Tuple[float, int, float, asyncio.Future]] = []
+        self.sequence = itertools.count()
+
+    @classmethod
+    def from_environment(cls) -> "FairScheduler":
+        return cls(
+            weights=_parse_overrides(os.getenv("TENANT_WEIGHTS", "")),
+            bursts=_parse_overrides(os.getenv("TENANT_BURSTS", "")),
+        )
+
+    def tenant(self, name: str) -> Tenant:
+        tenant = self.tenants.get(name)
+        if tenant is not None:
+            self.tenants.move_to_end(name)
+            return tenant
+
+        # Tenants come from whatever Authorization header arrives, so the map has to stay capped
+        if len(self.tenants) >= self.max_tenants:
+            self._forget_least_recently_used()
+        tenant = Tenant(name, self.weights.get(name, 1.0), self.rate, self.bursts.get(name, self.burst))
+        self.tenants[name] = tenant
+        return tenant
+
+    def _forget_least_recently_used(self) -> None:
+        # Busy tenants are skipped, there are at most as many as calls in progress
+        for name, tenant in self.tenants.items():
+            if not tenant.busy:
+                del self.tenants[name]
+                self.forgotten += 1
+                return
+
+    @asynccontextmanager
+    async def slot(self, tenant_name: str) -> AsyncIterator[None]:
+        """
+        Holds an upstream slot for the tenant for the duration of the block.
+
+        Waiting counts against the current request's deadline, and raises
+        DeadlineExceeded if the slot can't be had in time.
+
+        :param tenant_name: str
+        """
+        tenant = self.tenant(tenant_name)
+        started = time.monotonic()
+        tenant.waiting += 1
+        try:
+            delay = tenant.take_token()
+            if delay:
+                tenant.throttled += 1
+                deadline = current_deadline()
+                if deadline and deadline.remaining() < delay:
+                    # Give the token back, the call is not going to be made
+                    tenant.tokens += 1
+                    raise DeadlineExceeded("Tenant is over its rate and would run out of time waiting")
+                await asyncio.sleep(delay)
+
+            await self._acquire(tenant)
+        finally:
+            tenant.waiting -= 1
+            tenant.wait_time += time.monotonic() - started
+
+        tenant.in_flight += 1
+        tenant.granted += 1
+        # Only the call itself, not the wait above, is the upstream's doing
+        called_at = time.monotonic()
+        try:
+            yield
+        finally:
+            note_upstream_call(time.monotonic() - called_at)
+            tenant.in_flight -= 1
+            self._release()
+
+    async def _acquire(self, tenant: Tenant) -> None:
+        start_tag = max(self.virtual_time, tenant.last_finish)
+        tenant.last_finish = start_tag + 1 / tenant.weight
+
+        if self.in_use < self.capacity and not self.queue:
+            self.in_use += 1
+            self.virtual_time = start_tag
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (tenant.last_finish, next(self.sequence), start_tag, future))
+
+        deadline = current_deadline()
+        try:
+            await asyncio.wait_for(future, timeout=deadline.remaining() if deadline else None)
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("Ran out of time waiting for upstream capacity")
+        except asyncio.CancelledError:
+            # The slot may have been handed over just as we were cancelled
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self.queue:
+            _, _, start_tag, future = heapq.heappop(self.queue)
+            if future.done():
+                # Its waiter gave up
+                continue
+            self.virtual_time = start_tag
+            future.set_result(None)
+            return
+        self.in_use -= 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "in_use": self.in_use,
+            "queued": len(self.queue),
+            "forgotten_tenants": self.forgotten,
+            # Hash prefixes are enough to tell tenants apart
+            "tenants": {name[:12]: tenant.snapshot() for name, tenant in self.tenants.items()},
+        }
+
+
+scheduler = FairScheduler.from_environment()
+register_metrics("scheduler", scheduler.snapshot)
+
+_current_tenant: ContextVar[str] = ContextVar("tenant", default=ANONYMOUS_TENANT)
+
+
+@contextmanager
+def tenant_scope(tenant_name: str) -> Iterator[None]:
+    """
+    Makes a tenant current for everything awaited within the block.
+
+    :param tenant_name: str
+    """
+    token = _current_tenant.set(tenant_name)
+    try:
+        yield
+    finally:
+        _current_tenant.reset(token)
+
+
+def current_tenant() -> str:
+    """
+    Returns the tenant the current request is scheduled as.
+    """
+    return _current_tenant.get()
+
+
+def upstream_slot():
+    """
+    Holds an upstream slot for the current tenant.
+    """
+    return scheduler.slot(_current_tenant.get())
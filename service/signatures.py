@@ -0,0 +1,189 @@
+"""
+Verifies terminal signatures on key injection requests at the gateway.
+
+Terminals sign the JSON of their terminal_id, full_ksn and nonce (sorted
+keys) with RSA-PSS over SHA-256, as testing/test_client.py does. Checking
+that here lets us turn away forged or corrupted requests without a trip
+to the cryptography service and the HSM behind it.
+
+Parsed public keys are kept in an LRU cache keyed by terminal_id, and the
+RSA work runs in a thread pool so it never blocks the event loop.
+"""
+import asyncio
+import base64
+import binascii
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from service.logger import get_logger
+from service.metrics import register_metrics
+from service.models import RemoteKeyInjectionParameters
+
+logger = get_logger()
+
+# Off unless asked for, the cryptography service verifies signatures either way
+VERIFY_TERMINAL_SIGNATURES = os.getenv("VERIFY_TERMINAL_SIGNATURES", "False").lower() == "true"
+
+PUBLIC_KEY_CACHE_SIZE = int(os.getenv("PUBLIC_KEY_CACHE_SIZE", "10000"))
+SIGNATURE_WORKERS = int(os.getenv("SIGNATURE_WORKERS", "4"))
+
+_executor = ThreadPoolExecutor(max_workers=SIGNATURE_WORKERS, thread_name_prefix="signatures")
+
+
+class TerminalSignatureError(Exception):
+    """
+    Raised when a terminal's signature does not verify against its registered key
+    """
+    pass
+
+
+class PublicKeyCache:
+    """
+    LRU cache of parsed terminal public keys, keyed by terminal_id.
+
+    The PEM is kept next to the parsed key so a terminal which registers
+    a new key is never verified against its old one.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, Tuple[str, rsa.RSAPublicKey]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, terminal_id: str, pem: str) -> Optional[rsa.RSAPublicKey]:
+        entry = self.entries.get(terminal_id)
+        if entry is None or entry[0] != pem:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(terminal_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, terminal_id: str, pem: str, public_key: rsa.RSAPublicKey) -> None:
+        self.entries[terminal_id] = (pem, public_key)
+        self.entries.move_to_end(terminal_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def dump(self) -> List[Dict[str, str]]:
+        """
+        Returns the cached PEMs, least recently used first.
+        """
+        return [{"terminal_id": terminal_id, "pem": pem} for terminal_id, (pem, _) in self.entries.items()]
+
+
+public_key_cache = PublicKeyCache(PUBLIC_KEY_CACHE_SIZE)
+_counters = {"rejected": 0}
+
+
+def _snapshot():
+    return {
+        "enabled": VERIFY_TERMINAL_SIGNATURES,
+        "cached_keys": len(public_key_cache.entries),
+        "cache_hits": public_key_cache.hits,
+        "cache_misses": public_key_cache.misses,
+        "rejected": _counters["rejected"],
+    }
+
+
+register_metrics("signatures", _snapshot)
+
+
+def _load_public_key(pem: str) -> rsa.RSAPublicKey:
+    public_key = serialization.load_pem_public_key(pem.encode())
+    if not isinstance(public_key, rsa.RSAPublicKey):
+        raise TerminalSignatureError("Registered public key is not an RSA key")
+    return public_key
+
+
+def _verify(public_key: rsa.RSAPublicKey, signature: bytes, payload: bytes) -> None:
+    public_key.verify(
+        signature,
+        payload,
+        padding.PSS(
+            mgf=padding.MGF1(hashes.SHA256()),
+            salt_length=padding.PSS.MAX_LENGTH
+        ),
+        hashes.SHA256()
+    )
+
+
+def signed_payload(parameters: RemoteKeyInjectionParameters) -> bytes:
+    """
+    Returns the bytes a terminal signs when asking for a key.
+
+    :param parameters: RemoteKeyInjectionParameters
+    :return: bytes
+    """
+    payload = {
+        "terminal_id": parameters.terminal_id,
+        "full_ksn": parameters.full_ksn,
+        "nonce": parameters.nonce,
+    }
+    return json.dumps(payload, sort_keys=True).encode()
+
+
+async def verify_terminal_signature(parameters: RemoteKeyInjectionParameters) -> None:
+    """
+    Verifies the request signature against the terminal's registered public key.
+
+    Raises TerminalSignatureError if it doesn't verify.
+
+    :param parameters: RemoteKeyInjectionParameters
+    :return: None
+    """
+    try:
+        await _verify_terminal_signature(parameters)
+    except TerminalSignatureError:
+        _counters["rejected"] += 1
+        raise
+
+
+async def _verify_terminal_signature(parameters: RemoteKeyInjectionParameters) -> None:
+    try:
+        signature = base64.b64decode(parameters.signature, validate=True)
+    except (binascii.Error, ValueError):
+        raise TerminalSignatureError("Signature is not valid base64")
+
+    loop = asyncio.get_running_loop()
+
+    public_key = public_key_cache.get(parameters.terminal_id, parameters.public_key)
+    if public_key is None:
+        try:
+            public_key = await loop.run_in_executor(_executor, _load_public_key, parameters.public_key)
+        except ValueError:
+            raise TerminalSignatureError("Registered public key could not be parsed")
+        public_key_cache.put(parameters.terminal_id, parameters.public_key, public_key)
+
+    try:
+        await loop.run_in_executor(_executor, _verify, public_key, signature, signed_payload(parameters))
+    except InvalidSignature:
+        raise TerminalSignatureError(f"Signature does not verify for terminal {parameters.terminal_id}")
+
+
+async def restore_public_keys(entries: List[Dict[str, str]]) -> int:
+    """
+    Parses PEMs from `PublicKeyCache.dump` back into the cache, skipping any that don't parse.
+
+    :param entries: List[Dict[str, str]]
+    :return: int of keys restored
+    """
+    loop = asyncio.get_running_loop()
+    restored = 0
+    for entry in entries:
+        try:
+            public_key = await loop.run_in_executor(_executor, _load_public_key, entry["pem"])
+        except (ValueError, TerminalSignatureError):
+            continue
+        public_key_cache.put(entry["terminal_id"], entry["pem"], public_key)
+        restored += 1
+    return restored
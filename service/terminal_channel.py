@@ -0,0 +1,318 @@
+"""
+Persistent WebSocket channel for terminals.
+
+A terminal authenticates once when the socket is opened and then
+multiplexes transaction and remote key injection messages over the
+same connection. Every message carries an `id` which is echoed back
+on its reply, so replies may arrive in any order.
+
+Request message:
+    {"id": "1", "type": "transaction", "payload": {...}}
+
+Reply message:
+    {"id": "1", "status": 200, "result": {...}}
+    {"id": "1", "status": 400, "error": "..."}
+"""
+import asyncio
+import json
+import os
+from dataclasses import asdict
+from typing import Any, Dict, Optional
+
+from sanic import Request
+from sanic.exceptions import WebsocketClosed
+from sanic.server.websockets.impl import WebsocketImplProtocol
+from websockets.exceptions import ConnectionClosed
+
+from service.accounting import account_request, note_merchant, note_terminal
+from service.admission import AdmissionRejected, Priority, admission_controller
+from service.authorization import get_api_key_from_http_request, get_credentials_from_api_key, hash_api_key
+from service.cryptography import register_terminal, get_key_for_remote_key_injection, get_remote_key_injection_parameters_from_terminal_id
+from service.deadline import DeadlineExceeded, TRANSACTION_BUDGET, KEY_INJECTION_BUDGET, deadline_scope
+from service.environment import TRANSACTION_IS_QA, is_qa_environment
+from service.epx import EPXProcessor
+from service.json_util import UUIDEncoder
+from service.logger import get_logger
+from service.models import EPXCredentials, TransactionRequest, TerminalRegistryParameters, InitialRemoteKeyInjectionParameters
+from service.scheduling import ANONYMOUS_TENANT, tenant_scope
+from service.replay_filter import NonceReplayed, check_nonce
+from service.signatures import VERIFY_TERMINAL_SIGNATURES, TerminalSignatureError, verify_terminal_signature
+from service.validation import ValidationError, validate_payload
+
+logger = get_logger()
+
+# Maximum number of messages a single connection may have in flight.
+# Once reached, we stop reading from the socket until a reply goes out,
+# which pushes back on the terminal through the TCP window.
+MAX_IN_FLIGHT = int(os.getenv("WEBSOCKET_MAX_IN_FLIGHT", "8"))
+
+# Seconds a terminal has to authenticate when it did not send an
+# Authorization header with the upgrade request.
+AUTHENTICATION_TIMEOUT = float(os.getenv("WEBSOCKET_AUTHENTICATION_TIMEOUT", "10"))
+
+
+class ChannelMessageError(Exception):
+    """
+    Raised when a channel message cannot be handled
+    """
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class TerminalChannel:
+    """
+    Serves a single terminal WebSocket connection
+    """
+
+    def __init__(self, ws: WebsocketImplProtocol, api_key: Optional[str] = None):
+        self.ws = ws
+        self.api_key = api_key
+        self.credentials: Optional[EPXCredentials] = None
+        self.in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        self.tasks = set()
+
+    @property
+    def tenant(self) -> str:
+        return hash_api_key(self.api_key) if self.api_key else ANONYMOUS_TENANT
+
+    async def serve(self) -> None:
+        """
+        Authenticates the connection then dispatches messages until the terminal disconnects.
+        """
+        if not await self.authenticate():
+            return
+
+        try:
+            while True:
+                # Flow control: only read once there is room for another message
+                await self.in_flight.acquire()
+                raw = await self.ws.recv()
+
+                task = asyncio.create_task(self.dispatch(raw))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        except (ConnectionClosed, WebsocketClosed):
+            logger.info("Terminal channel closed")
+        finally:
+            for task in self.tasks:
+                task.cancel()
+
+    async def authenticate(self) -> bool:
+        """
+        Authenticates the connection once, either from the upgrade
+        request's Authorization header or from an `authenticate` message.
+        The connection is closed when it fails.
+
+        :return: bool
+        """
+        if not self.api_key:
+            try:
+                # recv returns None once the timeout elapses
+                raw = await self.ws.recv(timeout=AUTHENTICATION_TIMEOUT)
+                message = json.loads(raw) if raw else {}
+            except ValueError:
+                logger.exception("Terminal channel sent an invalid authentication message")
+                return await self.refuse()
+
+            if not isinstance(message, dict) or message.get("type") != "authenticate":
+                return await self.refuse()
+            self.api_key = message.get("api_key")
+            if not self.api_key:
+                return await self.refuse()
+
+        try:
+            # Scheduled as the key's own tenant, so a flood of junk keys only throttles itself
+            with deadline_scope(TRANSACTION_BUDGET), tenant_scope(self.tenant):
+                self.credentials = await get_credentials_from_api_key(self.api_key, TRANSACTION_IS_QA)
+        except DeadlineExceeded:
+            logger.info("Terminal channel authentication ran out of time")
+            return await self.refuse(code=4504, reason="Timed out while authenticating.")
+        except Exception:
+            logger.exception("Exception getting credentials from the provided API key")
+            return await self.refuse()
+
+        await self.ws.send(json.dumps({"type": "authenticated", "status": 200}))
+        return True
+
+    async def refuse(self, code: int = 4401, reason: str = "Not authorized to perform this action.") -> bool:
+        """
+        Closes a connection that failed to authenticate.
+
+        :param code: int WebSocket close code
+        :param reason: str
+        :return: bool always False, for authenticate to return
+        """
+        await self.ws.close(code=code, reason=reason)
+        return False
+
+    async def dispatch(self, raw: str) -> None:
+        """
+        Handles one message and sends its reply, releasing its in-flight slot.
+
+        :param raw: str
+        :return: None
+        """
+        message_id = None
+        try:
+            message = json.loads(raw)
+            if not isinstance(message, dict):
+                raise ChannelMessageError("Message must be a JSON object.")
+
+            message_id = message.get("id")
+            if message_id is None:
+                raise ChannelMessageError("Message is missing its id.")
+
+            handler = self.handlers.get(message.get("type"))
+            if handler is None:
+                raise ChannelMessageError(f"Unknown message type: {message.get('type')}")
+
+            payload = message.get("payload")
+            if not isinstance(payload, dict):
+                raise ChannelMessageError("Message payload must be a JSON object.")
+
+            priority = self.priorities[message.get("type")]
+            budget = TRANSACTION_BUDGET if priority is Priority.TRANSACTION else KEY_INJECTION_BUDGET
+            async with admission_controller.admit(priority):
+                with deadline_scope(budget), tenant_scope(self.tenant), account_request():
+                    if self.credentials is not None:
+                        note_merchant(self.credentials.MERCH_NBR, self.credentials.TERMINAL_NBR)
+                    result = await handler(self, payload)
+            reply = {"id": message_id, "status": 200, "result": result}
+        except AdmissionRejected as e:
+            reply = {"id": message_id, "status": 503, "error": str(e), "retry_after": e.retry_after}
+        except DeadlineExceeded as e:
+            reply = {"id": message_id, "status": 504, "error": str(e)}
+        except ChannelMessageError as e:
+            reply = {"id": message_id, "status": e.status_code, "error": str(e)}
+        except ValueError:
+            reply = {"id": message_id, "status": 400, "error": "Message is not valid JSON."}
+        except Exception:
+            logger.exception(f"Exception while handling channel message {message_id}")
+            reply = {"id": message_id, "status": 500, "error": "Unable to handle message."}
+        finally:
+            self.in_flight.release()
+
+        try:
+            await self.ws.send(json.dumps(reply, cls=UUIDEncoder))
+        except Exception:
+            logger.exception(f"Unable to send reply for channel message {message_id}")
+
+    async def handle_transaction(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Same as /p2pe/transaction, using the credentials gotten when the channel authenticated.
+
+        :param payload: Dict[str, Any]
+        :return: Dict[str, Any]
+        """
+        logger.info(f"Channel transaction called with the following parameters: {payload}")
+        try:
+            request_input = validate_payload(TransactionRequest, payload)
+        except ValidationError as e:
+            raise ChannelMessageError("; ".join(e.errors), status_code=422)
+
+        try:
+            processor = EPXProcessor(self.credentials, TRANSACTION_IS_QA)
+            result = await processor.charge(request_input)
+        except DeadlineExceeded:
+            raise
+        except Exception:
+            logger.exception("Exception while attempting to process")
+            raise ChannelMessageError("Unable to successfully complete transaction.")
+
+        return asdict(result)
+
+    async def handle_register_terminal(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Same as /p2pe/register-terminal-for-remote-key-injection.
+
+        :param payload: Dict[str, Any]
+        :return: Dict[str, Any]
+        """
+        logger.info(f"Channel register_terminal called with the following parameters: {payload}")
+        try:
+            request_input = validate_payload(TerminalRegistryParameters, payload)
+        except ValidationError as e:
+            raise ChannelMessageError("; ".join(e.errors), status_code=422)
+        note_terminal(request_input.terminal_id)
+
+        try:
+            return await register_terminal(request_input, self.api_key, is_qa_environment())
+        except DeadlineExceeded:
+            raise
+        except Exception:
+            logger.exception("Exception while attempting to register terminal")
+            raise ChannelMessageError("Unable to successfully complete terminal registration.")
+
+    async def handle_get_key(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Same as /p2pe/get-key-from-registered-terminal-for-remote-key-injection.
+
+        :param payload: Dict[str, Any]
+        :return: Dict[str, Any]
+        """
+        logger.info(f"Channel get_key called with the following parameters: {payload}")
+        try:
+            request_input = validate_payload(InitialRemoteKeyInjectionParameters, payload)
+        except ValidationError as e:
+            raise ChannelMessageError("; ".join(e.errors), status_code=422)
+        note_terminal(request_input.terminal_id)
+
+        try:
+            check_nonce(request_input.terminal_id, request_input.nonce)
+        except NonceReplayed as e:
+            raise ChannelMessageError(str(e), status_code=409)
+
+        is_qa = is_qa_environment()
+        try:
+            parameters = await get_remote_key_injection_parameters_from_terminal_id(
+                request_input, self.api_key, is_qa
+            )
+        except DeadlineExceeded:
+            raise
+        except Exception:
+            logger.exception("Exception while formatting remote key injection parameters.")
+            raise ChannelMessageError("Unable to get key injection parameters from provided terminal.")
+
+        if VERIFY_TERMINAL_SIGNATURES:
+            try:
+                await verify_terminal_signature(parameters)
+            except TerminalSignatureError:
+                logger.exception("Terminal signature failed verification")
+                raise ChannelMessageError("Terminal signature could not be verified.", status_code=401)
+
+        try:
+            return await get_key_for_remote_key_injection(parameters, is_qa)
+        except DeadlineExceeded:
+            raise
+        except Exception:
+            logger.exception("Exception while attempting to register terminal")
+            raise ChannelMessageError("Unable to successfully complete terminal key injection.")
+
+    handlers = {
+        "transaction": handle_transaction,
+        "register-terminal": handle_register_terminal,
+        "get-key": handle_get_key,
+    }
+
+    priorities = {
+        "transaction": Priority.TRANSACTION,
+        "register-terminal": Priority.KEY_INJECTION,
+        "get-key": Priority.KEY_INJECTION,
+    }
+
+
+async def serve_terminal_channel(request: Request, ws: WebsocketImplProtocol) -> None:
+    """
+    Entry point for a terminal WebSocket connection.
+
+    :param request: Request
+    :param ws: WebsocketImplProtocol
+    :return: None
+    """
+    api_key = None
+    if request.headers.get("Authorization"):
+        api_key = get_api_key_from_http_request(request)
+
+    await TerminalChannel(ws, api_key).serve()
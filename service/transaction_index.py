@@ -0,0 +1,138 @@
+"""
+In-memory index of recent transaction responses.
+
+When a terminal loses a response, support needs to know whether the
+charge went through. Every TransactionResponse from EPX is kept here,
+up to TRANSACTION_INDEX_SIZE entries and TRANSACTION_INDEX_MAX_AGE
+seconds, and can be found in constant time by AUTH_GUID,
+(MERCH_NBR, TRAN_NBR) or (MERCH_NBR, TERMINAL_NBR).
+
+Entries are evicted oldest first, so the oldest entry for any key is
+always the next one out.
+"""
+import os
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from service.metrics import register_metrics
+from service.models import TransactionResponse
+
+TRANSACTION_INDEX_SIZE = int(os.getenv("TRANSACTION_INDEX_SIZE", "100000"))
+TRANSACTION_INDEX_MAX_AGE = float(os.getenv("TRANSACTION_INDEX_MAX_AGE", str(24 * 60 * 60)))
+
+
+@dataclass
+class IndexedTransaction:
+    """
+    A transaction response and when we received it
+    """
+    sequence: int
+    recorded_at: float
+    response: TransactionResponse
+
+
+class TransactionIndex:
+    """
+    Size and age bounded index of recent transaction responses
+    """
+
+    def __init__(self, max_entries: int = TRANSACTION_INDEX_SIZE, max_age: float = TRANSACTION_INDEX_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.sequence = 0
+        self.entries: "OrderedDict[int, IndexedTransaction]" = OrderedDict()
+        self.by_auth_guid: Dict[str, int] = {}
+        self.by_tran_nbr: Dict[Tuple[str, str], int] = {}
+        self.by_terminal: Dict[Tuple[str, str], Deque[int]] = {}
+        self.evicted = 0
+
+    def record(self, response: TransactionResponse) -> None:
+        """
+        Adds a response to the index, evicting whatever has aged or overflowed out.
+
+        :param response: TransactionResponse
+        :return: None
+        """
+        self.sequence += 1
+        entry = IndexedTransaction(self.sequence, time.time(), response)
+        self.entries[entry.sequence] = entry
+
+        if response.AUTH_GUID:
+            self.by_auth_guid[response.AUTH_GUID] = entry.sequence
+        if response.TRAN_NBR:
+            self.by_tran_nbr[(str(response.MERCH_NBR), response.TRAN_NBR)] = entry.sequence
+        terminal = (str(response.MERCH_NBR), str(response.TERMINAL_NBR))
+        self.by_terminal.setdefault(terminal, deque()).append(entry.sequence)
+
+        self._evict()
+
+    def _evict(self) -> None:
+        oldest_allowed = time.time() - self.max_age
+        while self.entries:
+            sequence, entry = next(iter(self.entries.items()))
+            if len(self.entries) <= self.max_entries and entry.recorded_at >= oldest_allowed:
+                return
+
+            del self.entries[sequence]
+            self.evicted += 1
+            response = entry.response
+
+            # A later transaction may have reused the key, only drop it if it is still ours
+            if self.by_auth_guid.get(response.AUTH_GUID) == sequence:
+                del self.by_auth_guid[response.AUTH_GUID]
+            tran_key = (str(response.MERCH_NBR), response.TRAN_NBR)
+            if self.by_tran_nbr.get(tran_key) == sequence:
+                del self.by_tran_nbr[tran_key]
+
+            terminal = (str(response.MERCH_NBR), str(response.TERMINAL_NBR))
+            sequences = self.by_terminal.get(terminal)
+            if sequences:
+                sequences.popleft()
+                if not sequences:
+                    del self.by_terminal[terminal]
+
+    def _get(self, sequence: Optional[int]) -> Optional[IndexedTransaction]:
+        if sequence is None:
+            return None
+        entry = self.entries.get(sequence)
+        if entry is None or entry.recorded_at < time.time() - self.max_age:
+            return None
+        return entry
+
+    def by_auth_guid_for(self, merch_nbr: str, auth_guid: str) -> List[IndexedTransaction]:
+        entry = self._get(self.by_auth_guid.get(auth_guid))
+        if entry is None or str(entry.response.MERCH_NBR) != merch_nbr:
+            return []
+        return [entry]
+
+    def by_tran_nbr_for(self, merch_nbr: str, tran_nbr: str) -> List[IndexedTransaction]:
+        entry = self._get(self.by_tran_nbr.get((merch_nbr, tran_nbr)))
+        return [entry] if entry else []
+
+    def by_terminal_for(self, merch_nbr: str, terminal_nbr: str, limit: int = 20) -> List[IndexedTransaction]:
+        """
+        Returns the terminal's most recent transactions, newest first.
+        """
+        sequences = self.by_terminal.get((merch_nbr, terminal_nbr), ())
+        entries = []
+        for sequence in reversed(sequences):
+            entry = self._get(sequence)
+            if entry is None:
+                break
+            entries.append(entry)
+            if len(entries) >= limit:
+                break
+        return entries
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "terminals": len(self.by_terminal),
+            "evicted": self.evicted,
+        }
+
+
+transaction_index = TransactionIndex()
+register_metrics("transaction_index", transaction_index.snapshot)
@@ -0,0 +1,174 @@
+"""
+Addresses of, and pooled connections to, the services we call.
+
+In QA and in production pods, the IPEK registry and the cryptography
+service run next to the gateway. Each can be given as an http(s) base
+URL or as a Unix domain socket, for example:
+
+    IPEK_REGISTRY_QA_ADDRESS=unix:///run/ipek-registry.sock
+    CRYPTOGRAPHY_QA_ADDRESS=unix:///run/cryptography.sock
+
+Either way calls go through one session per upstream, so connections
+are kept alive and reused rather than opened for every call. Over a
+socket the TCP loopback is skipped entirely.
+
+The passthrough and every EPX endpoint get a pool too, so a new
+instance can open its connections (DNS and TLS included) before it
+takes traffic, see service/warm_start.py.
+"""
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Type
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+
+from service.logger import get_logger
+from service.metrics import register_metrics
+
+logger = get_logger()
+
+UNIX_SCHEME = "unix://"
+# Requests over a socket still need a host in their URL, it is never resolved
+UNIX_BASE_URL = "http://localhost"
+
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "100"))
+UPSTREAM_KEEPALIVE_TIMEOUT = float(os.getenv("UPSTREAM_KEEPALIVE_TIMEOUT", "60"))
+
+
+class Upstream:
+    """
+    One upstream service and the pooled session used to call it
+    """
+
+    def __init__(
+        self,
+        name: str,
+        address: str,
+        pool_size: int = UPSTREAM_POOL_SIZE,
+        resolver: Optional[Type[AbstractResolver]] = None,
+    ):
+        self.name = name
+        self.address = address.rstrip("/")
+        self.pool_size = pool_size
+        # Made within the running loop along with the session, aiohttp's default when not given
+        self.resolver = resolver
+        self.client: Optional[aiohttp.ClientSession] = None
+        upstreams.append(self)
+
+    @classmethod
+    def from_environment(cls, name: str, variable: str, default: str) -> "Upstream":
+        return cls(name, os.getenv(variable, default))
+
+    @property
+    def socket_path(self) -> Optional[str]:
+        if self.address.startswith(UNIX_SCHEME):
+            return self.address[len(UNIX_SCHEME):]
+        return None
+
+    @property
+    def base_url(self) -> str:
+        return UNIX_BASE_URL if self.socket_path else self.address
+
+    def url(self, path: str) -> str:
+        """
+        Returns the URL to request a path from this upstream with.
+
+        :param path: str starting with /
+        :return: str
+        """
+        return f"{self.base_url}{path}"
+
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Returns the pooled session, opening it on first use within the running loop.
+
+        :return: aiohttp.ClientSession
+        """
+        if self.client is None or self.client.closed:
+            if self.socket_path:
+                connector = aiohttp.UnixConnector(
+                    path=self.socket_path,
+                    limit=self.pool_size,
+                    keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT,
+                )
+            else:
+                connector = aiohttp.TCPConnector(
+                    limit=self.pool_size,
+                    keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT,
+                    resolver=self.resolver() if self.resolver else None,
+                )
+            self.client = aiohttp.ClientSession(connector=connector)
+            logger.info(f"Opened connection pool to {self.name} at {self.address}")
+        return self.client
+
+    async def warm(self, connections: int) -> int:
+        """
+        Opens connections to the upstream and leaves them in the pool, kept alive.
+
+        Any HTTP answer will do, the point is the DNS lookup, handshakes and sockets.
+
+        :param connections: int to open at once
+        :return: int of connections that were opened
+        """
+        session = self.session()
+
+        async def touch() -> bool:
+            try:
+                async with session.head(f"{self.base_url}/", allow_redirects=False) as response:
+                    await response.read()
+                return True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"Unable to pre-connect to {self.name} at {self.address}: {e!r}")
+                return False
+
+        opened = await asyncio.gather(*(touch() for _ in range(min(connections, self.pool_size))))
+        return sum(opened)
+
+    async def close(self) -> None:
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "address": self.address,
+            "open": self.client is not None and not self.client.closed,
+        }
+
+
+# Every upstream, in the order they were created
+upstreams: List[Upstream] = []
+
+passthrough = Upstream.from_environment("passthrough", "PASSTHROUGH_ADDRESS", "https://tripleplaypay.com")
+ipek_registry = Upstream.from_environment("ipek_registry", "IPEK_REGISTRY_ADDRESS", "https://tripleplaypay.com")
+ipek_registry_qa = Upstream.from_environment("ipek_registry_qa", "IPEK_REGISTRY_QA_ADDRESS", "http://localhost")
+cryptography_service = Upstream.from_environment(
+    "cryptography", "CRYPTOGRAPHY_ADDRESS", "https://cryptography.tripleplaypay.network"
+)
+cryptography_service_qa = Upstream.from_environment("cryptography_qa", "CRYPTOGRAPHY_QA_ADDRESS", "http://localhost:9001")
+
+register_metrics("upstreams", lambda: {upstream.name: upstream.snapshot() for upstream in upstreams})
+
+
+def ipek_registry_for(is_qa: bool) -> Upstream:
+    return ipek_registry_qa if is_qa else ipek_registry
+
+
+def cryptography_for(is_qa: bool) -> Upstream:
+    return cryptography_service_qa if is_qa else cryptography_service
+
+
+def sidecars_for(is_qa: bool) -> List[Upstream]:
+    """
+    Returns the non-EPX upstreams the platform calls.
+    """
+    return [passthrough, ipek_registry_for(is_qa), cryptography_for(is_qa)]
+
+
+async def close_upstreams() -> None:
+    """
+    Closes every pooled session, for server shutdown.
+    """
+    for upstream in upstreams:
+        await upstream.close()
@@ -0,0 +1,244 @@
+"""
+Validates inbound requests before any upstream call is made.
+
+Validators are built once at import time from the model dataclasses,
+so checking a request is only a few dictionary lookups and precompiled
+regular expression matches.
+"""
+import ipaddress
+import os
+import re
+from urllib.parse import urlparse
+from dataclasses import fields, MISSING
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar, Union
+
+from sanic import Request
+
+from service.json_util import ignore_properties
+from service.models import TransactionRequest, TerminalRegistryParameters, InitialRemoteKeyInjectionParameters
+
+_T = TypeVar("_T")
+
+# Transaction types EPX accepts from terminals
+ALLOWED_TRAN_TYPES = frozenset(
+    os.getenv("ALLOWED_TRAN_TYPES", "CCR0,CCR1,CCR2,CCR4,CCR7,CCR9,CCRX").split(",")
+)
+
+AMOUNT_PATTERN = re.compile(r"\d{1,7}\.\d{2}")
+CURRENCY_CODE_PATTERN = re.compile(r"\d{3}")
+HEX_PATTERN = re.compile(r"(?:[0-9A-Fa-f]{2})+")
+# Encrypted track data is not always whole bytes, certified swipes and EMV reads carry an odd number of digits
+HEX_DIGITS_PATTERN = re.compile(r"[0-9A-Fa-f]+")
+TRACK_PATTERN = re.compile(r"[\x20-\x7E]+")
+TERMINAL_ID_PATTERN = re.compile(r"[A-Za-z0-9_\-]{1,64}")
+NONCE_PATTERN = re.compile(r"[\x21-\x7E]{1,128}")
+BASE64_PATTERN = re.compile(r"[A-Za-z0-9+/]+={0,2}")
+
+# Hosts results may be posted back to, comma separated. A leading dot allows every subdomain.
+# When empty any host is allowed, as long as it does not resolve to an internal address.
+CALLBACK_ALLOWED_HOSTS = [
+    host.strip().lower() for host in os.getenv("CALLBACK_ALLOWED_HOSTS", "").split(",") if host.strip()
+]
+
+MAX_TRACK_DATA_LENGTH = 1024
+MAX_EMV_DATA_LENGTH = 2048
+MAX_PUBLIC_KEY_LENGTH = 4096
+MAX_SIGNATURE_LENGTH = 1024
+
+# Field check: takes the value and the whole payload, returns an error or None
+FieldCheck = Callable[[Any, Dict[str, Any]], Optional[str]]
+
+
+class ValidationError(Exception):
+    """
+    Contains the reasons a request failed validation
+    """
+
+    def __init__(self, errors: List[str]):
+        super().__init__("Request failed validation", errors)
+        self.errors = errors
+
+
+def _matches(pattern: re.Pattern, description: str, max_length: int = 0) -> FieldCheck:
+    def check(value: Any, payload: Dict[str, Any]) -> Optional[str]:
+        if not isinstance(value, str):
+            return "must be a string"
+        if max_length and len(value) > max_length:
+            return f"must be at most {max_length} characters"
+        if not pattern.fullmatch(value):
+            return f"must be {description}"
+        return None
+    return check
+
+
+def _check_tran_type(value: Any, payload: Dict[str, Any]) -> Optional[str]:
+    if value not in ALLOWED_TRAN_TYPES:
+        return f"must be one of {', '.join(sorted(ALLOWED_TRAN_TYPES))}"
+    return None
+
+
+_check_encrypted_track = _matches(HEX_DIGITS_PATTERN, "hex digits", MAX_TRACK_DATA_LENGTH)
+_check_clear_track = _matches(TRACK_PATTERN, "printable ASCII", MAX_TRACK_DATA_LENGTH)
+
+
+def _check_track_data(value: Any, payload: Dict[str, Any]) -> Optional[str]:
+    # Encrypted track data arrives hex encoded, anything else is raw track text
+    if payload.get("E2EE"):
+        return _check_encrypted_track(value, payload)
+    return _check_clear_track(value, payload)
+
+
+def _check_public_key(value: Any, payload: Dict[str, Any]) -> Optional[str]:
+    if not isinstance(value, str):
+        return "must be a string"
+    if len(value) > MAX_PUBLIC_KEY_LENGTH:
+        return f"must be at most {MAX_PUBLIC_KEY_LENGTH} characters"
+    if not value.lstrip().startswith("-----BEGIN PUBLIC KEY-----"):
+        return "must be a PEM encoded public key"
+    return None
+
+
+FIELD_CHECKS: Dict[type, Dict[str, FieldCheck]] = {
+    TransactionRequest: {
+        "AMOUNT": _matches(AMOUNT_PATTERN, "a decimal amount such as 1.00"),
+        "CURRENCY_CODE": _matches(CURRENCY_CODE_PATTERN, "a 3 digit ISO 4217 numeric code"),
+        "TRAN_TYPE": _check_tran_type,
+        "TRACK_DATA": _check_track_data,
+        "EMV_DATA": _matches(HEX_PATTERN, "hex encoded", MAX_EMV_DATA_LENGTH),
+    },
+    TerminalRegistryParameters: {
+        "terminal_id": _matches(TERMINAL_ID_PATTERN, "1 to 64 letters, digits, dashes or underscores"),
+        "public_key": _check_public_key,
+    },
+    InitialRemoteKeyInjectionParameters: {
+        "terminal_id": _matches(TERMINAL_ID_PATTERN, "1 to 64 letters, digits, dashes or underscores"),
+        "nonce": _matches(NONCE_PATTERN, "1 to 128 printable characters"),
+        "signature": _matches(BASE64_PATTERN, "base64 encoded", MAX_SIGNATURE_LENGTH),
+    },
+}
+
+
+def _compile(cls: type) -> Tuple[Tuple[str, ...], Tuple[Tuple[str, FieldCheck], ...]]:
+    """
+    Returns the required field names and field checks for a model.
+    """
+    required = tuple(
+        f.name for f in fields(cls)
+        if f.default is MISSING and f.default_factory is MISSING
+    )
+    checks = tuple(FIELD_CHECKS.get(cls, {}).items())
+    return required, checks
+
+
+_VALIDATORS = {cls: _compile(cls) for cls in FIELD_CHECKS}
+
+
+def _payload_errors(cls: type, payload: Any) -> List[str]:
+    if not isinstance(payload, dict):
+        return ["Request body must be a JSON object."]
+
+    required, checks = _VALIDATORS[cls]
+    errors = [f"{name} is required" for name in required if payload.get(name) in (None, "")]
+
+    for name, check in checks:
+        value = payload.get(name)
+        if value is None:
+            continue
+        error = check(value, payload)
+        if error:
+            errors.append(f"{name} {error}")
+
+    return errors
+
+
+def _header_errors(request: Request) -> List[str]:
+    authorization = request.headers.get("Authorization")
+    if not authorization or not authorization.strip():
+        return ["Authorization header is required"]
+    return []
+
+
+def validate_payload(cls: Type[_T], payload: Any) -> _T:
+    """
+    Validates a payload against one of the request models and returns the model.
+
+    :param cls: Type[_T]
+    :param payload: Any
+    :return: _T
+    """
+    errors = _payload_errors(cls, payload)
+    if errors:
+        raise ValidationError(errors)
+
+    return ignore_properties(cls, payload)
+
+
+def validate_headers(request: Request) -> None:
+    """
+    Makes sure a request carries the headers every /p2pe route needs.
+
+    :param request: Request
+    :return: None
+    """
+    errors = _header_errors(request)
+    if errors:
+        raise ValidationError(errors)
+
+
+def validate_request(cls: Type[_T], request: Request) -> _T:
+    """
+    Validates the Authorization header and JSON body of a request
+    against one of the request models and returns the model.
+
+    :param cls: Type[_T]
+    :param request: Request
+    :return: _T
+    """
+    payload = request.json
+    errors = _header_errors(request) + _payload_errors(cls, payload)
+    if errors:
+        raise ValidationError(errors)
+
+    return ignore_properties(cls, payload)
+
+
+def validate_callback_url(url: str) -> None:
+    """
+    Makes sure a callback URL is one we are willing to post results to.
+
+    :param url: str
+    :return: None
+    """
+    parsed = urlparse(url)
+    if parsed.scheme != "https" or not parsed.hostname:
+        raise ValidationError(["X-Callback-Url must be an absolute https URL"])
+
+    hostname = parsed.hostname.lower().rstrip(".")
+    if CALLBACK_ALLOWED_HOSTS and not any(
+        hostname.endswith(allowed) if allowed.startswith(".") else hostname == allowed
+        for allowed in CALLBACK_ALLOWED_HOSTS
+    ):
+        raise ValidationError(["X-Callback-Url host is not allowed"])
+
+    # Names are checked again against what they resolve to when the callback is made
+    if hostname == "localhost" or hostname.endswith(".localhost"):
+        raise ValidationError(["X-Callback-Url must not point at an internal address"])
+    try:
+        address = ipaddress.ip_address(hostname)
+    except ValueError:
+        return
+    if not is_public_address(address):
+        raise ValidationError(["X-Callback-Url must not point at an internal address"])
+
+
+def is_public_address(address: Union[ipaddress.IPv4Address, ipaddress.IPv6Address]) -> bool:
+    """
+    Whether an address is on the public internet, rather than loopback,
+    link-local (cloud metadata included), private, shared or reserved.
+
+    :param address: Union[IPv4Address, IPv6Address]
+    :return: bool
+    """
+    if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return address.is_global and not address.is_multicast
@@ -0,0 +1,177 @@
+"""
+Warm start for new instances.
+
+Before a worker accepts traffic it:
+
+1. restores the last snapshot of hot cache entries (authorized keys'
+   credentials and parsed terminal public keys), if one was written, and
+2. opens WARM_UP_CONNECTIONS keep-alive connections to each upstream of
+   its platform (passthrough, IPEK registry, cryptography and every EPX
+   endpoint), paying for DNS and TLS up front.
+
+Both happen in a before_server_start listener, and Sanic only reports
+the worker as ready on its health endpoint once those have run. Warm up
+gives up after WARM_UP_TIMEOUT seconds, so a slow upstream only costs a
+cold start rather than a stuck deploy.
+
+The snapshot is written every SNAPSHOT_INTERVAL seconds and on shutdown
+to SNAPSHOT_PATH, encrypted with Fernet under SNAPSHOT_KEY (generate one
+with `Fernet.generate_key()`). Snapshots older than SNAPSHOT_MAX_AGE
+seconds are ignored. Credentials are keyed by API key hash, the keys
+themselves are never written.
+"""
+import asyncio
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from service.authorization import credential_cache
+from service.environment import TRANSACTION_IS_QA
+from service.logger import get_logger
+from service.metrics import register_metrics
+from service.processor_endpoints import processor_endpoints
+from service.signatures import public_key_cache, restore_public_keys
+from service.upstreams import sidecars_for
+
+logger = get_logger()
+
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH")
+SNAPSHOT_KEY = os.getenv("SNAPSHOT_KEY")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "60"))
+SNAPSHOT_MAX_AGE = int(os.getenv("SNAPSHOT_MAX_AGE", "3600"))
+
+WARM_UP_CONNECTIONS = int(os.getenv("WARM_UP_CONNECTIONS", "4"))
+WARM_UP_TIMEOUT = float(os.getenv("WARM_UP_TIMEOUT", "10"))
+
+SNAPSHOT_VERSION = 1
+
+_stats: Dict[str, Any] = {
+    "warm_up_seconds": None,
+    "connections": 0,
+    "restored_credentials": 0,
+    "restored_public_keys": 0,
+    "snapshots_written": 0,
+}
+register_metrics("warm_start", lambda: dict(_stats))
+
+
+def _fernet() -> Optional[Fernet]:
+    if not SNAPSHOT_PATH or not SNAPSHOT_KEY:
+        return None
+    return Fernet(SNAPSHOT_KEY)
+
+
+def take_snapshot() -> Dict[str, Any]:
+    """
+    Copies the hot cache entries, on the event loop so they can't change underneath us.
+    """
+    return {
+        "version": SNAPSHOT_VERSION,
+        "credentials": credential_cache.dump(),
+        "public_keys": public_key_cache.dump(),
+    }
+
+
+def write_snapshot(snapshot: Dict[str, Any]) -> bool:
+    """
+    Encrypts a snapshot to SNAPSHOT_PATH, replacing the last one.
+
+    :param snapshot: Dict[str, Any] from take_snapshot
+    :return: bool whether a snapshot was written
+    """
+    fernet = _fernet()
+    if fernet is None:
+        return False
+
+    token = fernet.encrypt(json.dumps(snapshot, separators=(",", ":")).encode())
+
+    # Write beside it and swap, so a crash mid-write leaves the last snapshot intact.
+    # Every worker writes the same snapshot path, so each needs its own temporary file.
+    temporary_path = f"{SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "wb") as f:
+        f.write(token)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, SNAPSHOT_PATH)
+
+    _stats["snapshots_written"] += 1
+    return True
+
+
+async def restore_snapshot() -> None:
+    """
+    Loads the last snapshot back into the caches, if there is a usable one.
+    """
+    fernet = _fernet()
+    if fernet is None or not os.path.exists(SNAPSHOT_PATH):
+        return
+
+    try:
+        with open(SNAPSHOT_PATH, "rb") as f:
+            snapshot = json.loads(fernet.decrypt(f.read(), ttl=SNAPSHOT_MAX_AGE))
+    except InvalidToken:
+        logger.error(f"Snapshot {SNAPSHOT_PATH} is too old or was not written with this SNAPSHOT_KEY, starting cold")
+        return
+    except (OSError, ValueError):
+        logger.exception(f"Unable to read snapshot {SNAPSHOT_PATH}, starting cold")
+        return
+
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        logger.error(f"Snapshot {SNAPSHOT_PATH} is version {snapshot.get('version')}, starting cold")
+        return
+
+    _stats["restored_credentials"] = credential_cache.load(snapshot.get("credentials", []))
+    _stats["restored_public_keys"] = await restore_public_keys(snapshot.get("public_keys", []))
+
+
+async def pre_connect(is_qa: bool) -> None:
+    """
+    Opens keep-alive connections to every upstream of the platform.
+
+    The EPX endpoints are those transactions are sent to, which need not be the platform's.
+    """
+    if WARM_UP_CONNECTIONS <= 0:
+        return
+
+    epx_endpoints = processor_endpoints(TRANSACTION_IS_QA).endpoints
+    upstreams = sidecars_for(is_qa) + [endpoint.upstream for endpoint in epx_endpoints]
+    opened = await asyncio.gather(*(upstream.warm(WARM_UP_CONNECTIONS) for upstream in upstreams))
+    _stats["connections"] = sum(opened)
+
+
+async def warm_up(is_qa: bool) -> None:
+    """
+    Restores the snapshot and pre-connects upstreams, giving up after WARM_UP_TIMEOUT.
+
+    :param is_qa: bool
+    :return: None
+    """
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(asyncio.gather(restore_snapshot(), pre_connect(is_qa)), WARM_UP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"Warm up did not finish within {WARM_UP_TIMEOUT}s, taking traffic anyway")
+
+    _stats["warm_up_seconds"] = round(time.monotonic() - started, 3)
+    logger.info(f"Warm up finished in {_stats['warm_up_seconds']}s: {_stats}")
+
+
+async def write_snapshots_periodically() -> None:
+    """
+    Writes a snapshot every SNAPSHOT_INTERVAL seconds, forever.
+    """
+    if _fernet() is None:
+        return
+
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            # Keeps the encryption and fsync off the event loop
+            await loop.run_in_executor(None, write_snapshot, take_snapshot())
+        except OSError:
+            logger.exception(f"Unable to write snapshot {SNAPSHOT_PATH}")
@@ -0,0 +1,284 @@
+"""
+Replays the certified EPX traffic in docs/certification.txt through the gateway.
+
+Every request and response pair in the certification file becomes a
+fixture. The recorded responses are served by a local EPX stand-in, and
+the requests are sent through /p2pe/transaction, at a speed-up of the
+recorded pace (from each response's LOCAL_TIME) and a bounded
+concurrency. Each run checks two things:
+
+1. the gateway sends EPX exactly the certified request body (apart from
+   BATCH_ID and TRAN_NBR, which it sets per request), since the
+   stand-in only answers bodies it has a recording for, and
+2. every field of the TransactionResponse the gateway returns equals
+   the certified response, a missing field being null.
+
+When the same request was recorded more than once, its responses are
+served in turn and a response matching any of them passes.
+
+Start the gateway pointed at the stand-ins, then run the replay:
+
+    IS_QA=true EPX_QA_ENDPOINTS=http://127.0.0.1:9100 PASSTHROUGH_ADDRESS=http://127.0.0.1:9101 python app.py
+    python testing/certification_replay.py --speed-up 600 --concurrency 8 --repeat 20
+
+It exits non-zero if anything differs from the certification.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from urllib import parse
+
+import aiohttp
+
+from stand_ins import EPXStandIn, PassthroughStandIn, epx_request_signature, start_site
+
+CERTIFICATION_FILE = os.path.join(os.path.dirname(__file__), "..", "docs", "certification.txt")
+
+SEPARATOR = re.compile(r"^-{20,}$")
+# Fields the gateway fills in itself, from the passthrough or per request
+GATEWAY_FIELDS = ("BATCH_ID", "TRAN_NBR", "CUST_NBR", "MERCH_NBR", "DBA_NBR", "TERMINAL_NBR")
+CREDENTIAL_FIELDS = ("CUST_NBR", "MERCH_NBR", "DBA_NBR", "TERMINAL_NBR")
+
+
+@dataclass
+class Fixture:
+    """One certified request and response pair"""
+    title: str
+    request: List[Tuple[str, str]]
+    response: Dict[str, Optional[str]]
+    api_key: str = ""
+    offset: float = 0.0
+
+    @property
+    def signature(self) -> str:
+        return epx_request_signature(self.request)
+
+    @property
+    def payload(self) -> Dict[str, str]:
+        """What a terminal sends the gateway for this transaction"""
+        return {key: value for key, value in self.request if key not in GATEWAY_FIELDS}
+
+    @property
+    def credentials(self) -> Dict[str, Any]:
+        fields = dict(self.request)
+        return {key: int(fields[key]) if fields[key].isdigit() else fields[key] for key in CREDENTIAL_FIELDS}
+
+
+def parse_certification(text: str) -> Tuple[List[Fixture], List[str]]:
+    """
+    Splits the certification file into fixtures, skipping sections whose recording is incomplete.
+
+    :return: (fixtures, reasons sections were skipped)
+    """
+    lines = text.splitlines()
+    sections = []
+    i = 0
+    while i < len(lines):
+        # A section starts with its title between two separator lines
+        if SEPARATOR.match(lines[i].strip()) and i + 2 < len(lines) and SEPARATOR.match(lines[i + 2].strip()):
+            sections.append((lines[i + 1].strip(), []))
+            i += 3
+            continue
+        if sections:
+            sections[-1][1].append(lines[i])
+        i += 1
+
+    fixtures, skipped = [], []
+    for title, body in sections:
+        request_line, response_lines, part = None, [], None
+        for line in body:
+            stripped = line.strip()
+            if stripped.rstrip(":") == "Request":
+                part = "request"
+            elif stripped.rstrip(":") == "Response":
+                part = "response"
+            elif part == "request" and stripped and request_line is None:
+                # Some requests were pasted with the shell quote that closed them
+                request_line = stripped.rstrip("'")
+            elif part == "response":
+                response_lines.append(line)
+
+        if not request_line:
+            skipped.append(f"{title}: no request recorded")
+            continue
+        try:
+            response = json.loads("\n".join(response_lines))
+        except ValueError:
+            skipped.append(f"{title}: recorded response is not complete JSON")
+            continue
+
+        request = parse.parse_qsl(request_line, keep_blank_values=True)
+        fixtures.append(Fixture(title, request, response))
+
+    return fixtures, skipped
+
+
+def schedule(fixtures: List[Fixture], speed_up: float) -> float:
+    """
+    Sets each fixture's offset from the first from the recorded LOCAL_TIME gaps, returning the span.
+    """
+    def seconds(local_time: Optional[str]) -> Optional[int]:
+        if not local_time or len(local_time) != 6 or not local_time.isdigit():
+            return None
+        return int(local_time[:2]) * 3600 + int(local_time[2:4]) * 60 + int(local_time[4:])
+
+    first, previous = None, 0.0
+    for fixture in fixtures:
+        recorded = seconds(fixture.response.get("LOCAL_TIME"))
+        if recorded is None or speed_up <= 0:
+            # Without a time of its own it goes out with the one before it
+            fixture.offset = previous
+            continue
+        if first is None:
+            first = recorded
+        fixture.offset = previous = max(previous, (recorded - first) / speed_up)
+    return previous
+
+
+def differences(fixture_responses: List[Dict[str, Optional[str]]], returned: Dict[str, Any]) -> List[str]:
+    """
+    Returns how a returned TransactionResponse differs from the closest recorded one, empty if it equals one.
+    """
+    closest = None
+    for recorded in fixture_responses:
+        diff = [
+            f"{key}: expected {recorded.get(key)!r}, got {returned.get(key)!r}"
+            for key in sorted(set(recorded) | set(returned))
+            if recorded.get(key) != returned.get(key)
+        ]
+        if not diff:
+            return []
+        if closest is None or len(diff) < len(closest):
+            closest = diff
+    return closest
+
+
+@dataclass
+class ReplayResults:
+    """Latencies, mismatches and failures of one replay"""
+    latencies: Dict[str, List[float]] = field(default_factory=dict)
+    mismatches: List[str] = field(default_factory=list)
+    failures: List[str] = field(default_factory=list)
+
+    def report(self, elapsed: float, sent: int) -> str:
+        lines = [
+            f"{sent} transactions in {elapsed:.2f}s ({sent / elapsed:.1f}/s)",
+            f"{'fixture':<44}{'ok':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+        ]
+        for title, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            row = f"{title[:43]:<44}{len(values):>6}"
+            for quantile in (0.5, 0.9, 0.99, 1.0):
+                row += f"{values[min(len(values) - 1, int(quantile * len(values)))] * 1000:>10.1f}"
+            lines.append(row)
+        lines.append(f"{len(self.mismatches)} responses differed from the certification, {len(self.failures)} requests failed")
+        lines.extend(self.mismatches[:10])
+        lines.extend(self.failures[:10])
+        return "\n".join(lines)
+
+
+async def replay_fixture(
+    session: aiohttp.ClientSession,
+    gateway: str,
+    fixture: Fixture,
+    recorded_responses: List[Dict[str, Optional[str]]],
+    results: ReplayResults,
+) -> None:
+    start = time.perf_counter()
+    try:
+        async with session.post(
+            f"{gateway}/p2pe/transaction",
+            json=fixture.payload,
+            headers={"Authorization": f"Bearer {fixture.api_key}"},
+        ) as response:
+            body = await response.text()
+            if response.status != 200:
+                results.failures.append(f"{fixture.title}: HTTP {response.status} {body[:200]}")
+                return
+    except aiohttp.ClientError as e:
+        results.failures.append(f"{fixture.title}: {e!r}")
+        return
+
+    results.latencies.setdefault(fixture.title, []).append(time.perf_counter() - start)
+    diff = differences(recorded_responses, json.loads(body))
+    if diff:
+        results.mismatches.append(f"{fixture.title}: " + "; ".join(diff))
+
+
+async def run_replay(args) -> int:
+    with open(args.certification) as f:
+        fixtures, skipped = parse_certification(f.read())
+    for reason in skipped:
+        print(f"Skipping {reason}")
+    if not fixtures:
+        print("No complete fixtures to replay")
+        return 1
+
+    # One API key per set of credentials, the passthrough stand-in answers with them
+    credentials_by_key = {}
+    for fixture in fixtures:
+        fixture.api_key = "certification-" + "-".join(str(value) for value in fixture.credentials.values())
+        credentials_by_key[fixture.api_key] = fixture.credentials
+
+    responses_by_signature: Dict[str, List[Dict[str, Optional[str]]]] = {}
+    for fixture in fixtures:
+        responses_by_signature.setdefault(fixture.signature, []).append(fixture.response)
+
+    epx = EPXStandIn(responses_by_signature)
+    runners = [
+        await start_site(epx.application(), args.epx_port),
+        await start_site(PassthroughStandIn(credentials_by_key).application(), args.passthrough_port),
+    ]
+
+    span = schedule(fixtures, args.speed_up)
+    results = ReplayResults()
+    concurrency = asyncio.Semaphore(args.concurrency)
+
+    async def send(fixture: Fixture) -> None:
+        async with concurrency:
+            await replay_fixture(session, args.gateway, fixture, responses_by_signature[fixture.signature], results)
+
+    try:
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            tasks = []
+            for repetition in range(args.repeat):
+                for fixture in fixtures:
+                    delay = started + repetition * span + fixture.offset - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    tasks.append(asyncio.create_task(send(fixture)))
+            await asyncio.gather(*tasks)
+            elapsed = loop.time() - started
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+    print(results.report(elapsed, len(tasks)))
+    if epx.unmatched:
+        print(f"{epx.unmatched} requests reached EPX differing from every certified request")
+    return 1 if results.mismatches or results.failures or epx.unmatched else 0
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Replays the certified EPX traffic through the gateway")
+    parser.add_argument("--gateway", default="http://localhost:8000", help="Base URL of the gateway")
+    parser.add_argument("--certification", default=CERTIFICATION_FILE, help="Certification file to replay")
+    parser.add_argument("--speed-up", type=float, default=600, help="Times faster than recorded, 0 for no pacing")
+    parser.add_argument("--concurrency", type=int, default=8, help="Most transactions in flight at once")
+    parser.add_argument("--repeat", type=int, default=1, help="Times to replay the whole certification")
+    parser.add_argument("--epx-port", type=int, default=9100, help="Port for the EPX stand-in")
+    parser.add_argument("--passthrough-port", type=int, default=9101, help="Port for the passthrough stand-in")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run_replay(parse_arguments())))
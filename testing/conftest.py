@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The service package lives at the repository root, next to this directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,303 @@
+"""
+Asynchronous terminal fleet simulator for remote key injection load tests.
+
+Drives thousands of virtual terminals through register and request_ipek
+against the gateway at a target rate, then reports latency percentiles
+per phase. Terminals are scheduled at the target rate whether or not the
+gateway keeps up: `queued` is how long a terminal waited past its
+scheduled start for a free slot, and `end_to_end` runs from the
+scheduled start to its key, so a slow gateway shows in the percentiles
+rather than in a quietly lower rate. It is built for simulating a key
+rotation wave:
+
+1. RSA keys come from a pool kept on disk, so they are generated once
+   rather than on every run
+2. Key generation and request signing run in a process pool, leaving
+   the event loop free to keep requests going out at the target rate
+3. Every terminal is a TerminalClient speaking the same payloads as
+   test_client.py, over a shared aiohttp session
+
+Example, against local stand-ins for the registry and cryptography service.
+By default they listen where a QA gateway looks for them, the registry on
+port 80 (which usually needs root). Pick other ports, or unix:// socket
+paths, and point the gateway at them:
+
+    IS_QA=true IPEK_REGISTRY_QA_ADDRESS=http://localhost:9000 CRYPTOGRAPHY_QA_ADDRESS=http://localhost:9001 python app.py
+    python testing/fleet_simulator.py --terminals 5000 --rate 250 --stand-ins --registry-port 9000 --cryptography-port 9001
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple, Union
+
+import aiohttp
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+
+from stand_ins import CRYPTOGRAPHY_PORT, REGISTRY_PORT, start_key_injection_stand_ins
+from test_client import TerminalClient
+
+# Private keys loaded by this worker process, by path
+_loaded_keys = {}
+
+
+def _generate_key(path: str) -> None:
+    """Generates a pool key, writing the private and public PEMs next to each other"""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with open(path, "wb") as f:
+        f.write(private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        ))
+    with open(f"{path}.pub", "wb") as f:
+        f.write(private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ))
+
+
+def _sign(key_path: str, payload: bytes) -> str:
+    """Signs a payload with a pool key, the same way TerminalClient._sign_payload does"""
+    private_key = _loaded_keys.get(key_path)
+    if private_key is None:
+        with open(key_path, "rb") as f:
+            private_key = serialization.load_pem_private_key(f.read(), password=None)
+        _loaded_keys[key_path] = private_key
+
+    signature = private_key.sign(
+        payload,
+        padding.PSS(
+            mgf=padding.MGF1(hashes.SHA256()),
+            salt_length=padding.PSS.MAX_LENGTH
+        ),
+        hashes.SHA256()
+    )
+    return base64.b64encode(signature).decode()
+
+
+class KeyPool:
+    """Pre-generated terminal keys kept on disk between runs"""
+
+    def __init__(self, directory: str, size: int):
+        self.directory = directory
+        self.size = size
+        self.keys: List[Tuple[str, str]] = []
+
+    async def load(self, executor: ProcessPoolExecutor) -> None:
+        """Generates whatever keys are missing from the pool, then loads the public halves"""
+        os.makedirs(self.directory, exist_ok=True)
+        paths = [os.path.join(self.directory, f"key_{i:05d}.pem") for i in range(self.size)]
+        missing = [path for path in paths if not os.path.exists(f"{path}.pub")]
+
+        if missing:
+            print(f"Generating {len(missing)} pool keys in {self.directory}")
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(executor, _generate_key, path) for path in missing))
+
+        for path in paths:
+            with open(f"{path}.pub") as f:
+                self.keys.append((path, f.read()))
+
+    def key_for(self, index: int) -> Tuple[str, str]:
+        return self.keys[index % len(self.keys)]
+
+
+class PhaseStats:
+    """Latencies and errors recorded per phase"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, phase: str, latency: float) -> None:
+        self.latencies.setdefault(phase, []).append(latency)
+
+    def error(self, phase: str) -> None:
+        self.errors[phase] = self.errors.get(phase, 0) + 1
+
+    def report(self, elapsed: float, terminals: int) -> str:
+        lines = [
+            f"{terminals} terminals in {elapsed:.2f}s ({terminals / elapsed:.1f}/s)",
+            f"{'phase':<16}{'ok':>8}{'errors':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+        ]
+        for phase in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies.get(phase, []))
+            row = f"{phase:<16}{len(values):>8}{self.errors.get(phase, 0):>8}"
+            for quantile in (0.5, 0.9, 0.99, 1.0):
+                value = values[min(len(values) - 1, int(quantile * len(values)))] * 1000 if values else 0
+                row += f"{value:>10.1f}"
+            lines.append(row)
+        return "\n".join(lines)
+
+
+class VirtualTerminal(TerminalClient):
+    """
+    A TerminalClient whose key comes from the pool and whose requests are asynchronous
+    """
+
+    def __init__(self, terminal_id, api_key, service_url, key_path, public_key_pem):
+        self.key_path = key_path
+        self.public_key_pem = public_key_pem
+        super().__init__(terminal_id, api_key, service_url)
+
+    def _load_or_generate_keys(self):
+        # The private key is only ever loaded inside the signing processes
+        pass
+
+    async def register_async(self, session: aiohttp.ClientSession) -> None:
+        payload = {
+            "terminal_id": self.terminal_id,
+            "public_key": self.public_key_pem,
+        }
+        async with session.post(
+            f"{self.service_url}/p2pe/register-terminal-for-remote-key-injection",
+            json=payload,
+            headers={"Authorization": f"Bearer {self.api_key}"}
+        ) as response:
+            response.raise_for_status()
+            response_data = await response.json()
+        self.full_ksn = response_data["message"]["full_ksn"]
+
+    async def sign_async(self, executor: ProcessPoolExecutor, payload: dict) -> str:
+        # Same canonical form as TerminalClient._sign_payload
+        message = json.dumps(payload, sort_keys=True).encode()
+        return await asyncio.get_running_loop().run_in_executor(executor, _sign, self.key_path, message)
+
+    async def request_ipek_async(self, session: aiohttp.ClientSession, signature: str, payload: dict) -> dict:
+        payload = dict(payload, signature=signature)
+        async with session.post(
+            f"{self.service_url}/p2pe/get-key-from-registered-terminal-for-remote-key-injection",
+            json=payload,
+            headers={"Authorization": f"Bearer {self.api_key}"}
+        ) as response:
+            response.raise_for_status()
+            response_data = await response.json()
+
+        if response_data.get("nonce") != payload["nonce"]:
+            raise ValueError("Nonce mismatch! Possible replay attack.")
+        return response_data
+
+
+async def drive_terminal(
+    terminal: VirtualTerminal,
+    session: aiohttp.ClientSession,
+    executor: ProcessPoolExecutor,
+    stats: PhaseStats,
+) -> bool:
+    """Takes one terminal through registration and an IPEK request, timing each phase, returning if it succeeded"""
+    phase = "register"
+    try:
+        start = time.perf_counter()
+        await terminal.register_async(session)
+        stats.record(phase, time.perf_counter() - start)
+
+        phase = "sign"
+        payload = {
+            "terminal_id": terminal.terminal_id,
+            "full_ksn": terminal.full_ksn,
+            "nonce": str(uuid.uuid4()),
+        }
+        start = time.perf_counter()
+        signature = await terminal.sign_async(executor, payload)
+        stats.record(phase, time.perf_counter() - start)
+
+        phase = "request_ipek"
+        start = time.perf_counter()
+        await terminal.request_ipek_async(session, signature, payload)
+        stats.record(phase, time.perf_counter() - start)
+        return True
+    except aiohttp.ClientResponseError as e:
+        stats.error(phase)
+        if stats.errors[phase] <= 5:
+            print(f"{terminal.terminal_id} failed to {phase}: HTTP {e.status}")
+    except Exception as e:
+        stats.error(phase)
+        if stats.errors[phase] <= 5:
+            print(f"{terminal.terminal_id} failed to {phase}: {e!r}")
+    return False
+
+
+def stand_in_address(value: str) -> Union[int, str]:
+    if value.startswith("unix://"):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is neither a port nor a unix:// path")
+
+
+async def run_fleet(args) -> None:
+    stand_ins = []
+    if args.stand_ins:
+        stand_ins = await start_key_injection_stand_ins(args.registry_port, args.cryptography_port)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        pool = KeyPool(args.key_pool, args.pool_size)
+        await pool.load(executor)
+
+        stats = PhaseStats()
+        concurrency = asyncio.Semaphore(args.concurrency)
+        run_id = uuid.uuid4().hex[:6].upper()
+
+        async def launch(terminal: VirtualTerminal, scheduled: float) -> None:
+            # Timed from when the terminal was due to start, not from when it got a slot,
+            # so waiting on a slow gateway is not left out (coordinated omission)
+            async with concurrency:
+                stats.record("queued", time.perf_counter() - scheduled)
+                if await drive_terminal(terminal, session, executor, stats):
+                    stats.record("end_to_end", time.perf_counter() - scheduled)
+
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            started = time.perf_counter()
+            tasks = []
+            for i in range(args.terminals):
+                # Pace launches to the target rate rather than firing them all at once
+                scheduled = started + i / args.rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                key_path, public_key_pem = pool.key_for(i)
+                terminal = VirtualTerminal(f"SIM{run_id}{i:06d}", args.api_key, args.gateway, key_path, public_key_pem)
+                tasks.append(asyncio.create_task(launch(terminal, scheduled)))
+
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+
+    for runner in stand_ins:
+        await runner.cleanup()
+
+    print(stats.report(elapsed, args.terminals))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Simulates a fleet of terminals going through key injection")
+    parser.add_argument("--gateway", default="http://localhost:8000", help="Base URL of the gateway")
+    parser.add_argument("--api-key", default=os.getenv("API_KEY", "simulator"), help="API key the terminals use")
+    parser.add_argument("--terminals", type=int, default=1000, help="Number of virtual terminals")
+    parser.add_argument("--rate", type=float, default=100, help="Terminals started per second")
+    parser.add_argument("--concurrency", type=int, default=200, help="Most terminals in flight at once")
+    parser.add_argument("--key-pool", default=".fleet_keys", help="Directory holding the pre-generated keys")
+    parser.add_argument("--pool-size", type=int, default=200, help="Number of keys in the pool")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes for key generation and signing")
+    parser.add_argument("--stand-ins", action="store_true", help="Serve the registry and cryptography stand-ins locally")
+    parser.add_argument(
+        "--registry-port", type=stand_in_address, default=REGISTRY_PORT,
+        help="Port or unix:// path for the registry stand-in, point IPEK_REGISTRY_QA_ADDRESS at it"
+    )
+    parser.add_argument(
+        "--cryptography-port", type=stand_in_address, default=CRYPTOGRAPHY_PORT,
+        help="Port or unix:// path for the cryptography stand-in, point CRYPTOGRAPHY_QA_ADDRESS at it"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_fleet(parse_arguments()))
@@ -0,0 +1,229 @@
+"""
+Local stand-ins for the services the gateway calls upstream.
+
+These let the gateway be driven end to end on one machine, for load
+tests and harnesses, without reaching the real IPEK registry or the
+cryptography service and its HSM.
+
+- registry:     the IPEK registry, POST /api/ipek and GET /api/ipek/terminal/{id}
+- cryptography: the cryptography service, POST /api/ipek
+- passthrough:  the credential passthrough, POST /passthrough
+- epx:          EPX, answering recorded XML responses to the requests they were recorded for
+
+Run the gateway with IS_QA=true so it calls the stand-ins on localhost,
+or serve them on Unix sockets and point IPEK_REGISTRY_QA_ADDRESS and
+CRYPTOGRAPHY_QA_ADDRESS at those.
+"""
+import base64
+import json
+import os
+import uuid
+from itertools import count
+from typing import Any, Dict, List, Optional, Union
+from urllib import parse
+from xml.sax.saxutils import escape, quoteattr
+
+from aiohttp import web
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+
+# Where the gateway looks for each service when IS_QA=true
+REGISTRY_PORT = 80
+CRYPTOGRAPHY_PORT = 9001
+
+
+def _pss():
+    return padding.PSS(
+        mgf=padding.MGF1(hashes.SHA256()),
+        salt_length=padding.PSS.MAX_LENGTH
+    )
+
+
+class RegistryStandIn:
+    """
+    Keeps registered terminals in memory and hands out KSNs
+    """
+
+    def __init__(self, service_public_key_pem: str):
+        self.service_public_key_pem = service_public_key_pem
+        self.terminals = {}
+
+    async def register(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        full_ksn = f"FFFF{os.urandom(8).hex().upper()}"
+        self.terminals[body["terminal_id"]] = {
+            "terminal_id": body["terminal_id"],
+            "public_key": body["public_key"],
+            "full_ksn": full_ksn,
+        }
+        return web.json_response({
+            "message": {
+                "full_ksn": full_ksn,
+                "service_public_key": self.service_public_key_pem,
+            }
+        })
+
+    async def get_terminal(self, request: web.Request) -> web.Response:
+        terminal = self.terminals.get(request.match_info["terminal_id"])
+        if terminal is None:
+            return web.json_response({"message": "Terminal not found"}, status=404)
+        return web.json_response({"message": dict(terminal)})
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/ipek", self.register)
+        app.router.add_get("/api/ipek/terminal/{terminal_id}", self.get_terminal)
+        return app
+
+
+class CryptographyStandIn:
+    """
+    Returns a random IPEK encrypted to the terminal's key and signed by the service key
+    """
+
+    def __init__(self, service_private_key: rsa.RSAPrivateKey):
+        self.service_private_key = service_private_key
+
+    async def get_ipek(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        terminal_key = serialization.load_pem_public_key(body["public_key"].encode())
+        ipek = os.urandom(16)
+
+        response_data = {
+            "encrypted_ipek": base64.b64encode(terminal_key.encrypt(
+                ipek,
+                padding.OAEP(
+                    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                    algorithm=hashes.SHA256(),
+                    label=None
+                )
+            )).decode(),
+            "ksn": body["full_ksn"],
+            "kcv": ipek.hex().upper()[:6],
+            "nonce": body["nonce"],
+            "request_id": str(uuid.uuid4()),
+        }
+        signature = self.service_private_key.sign(
+            json.dumps(response_data, sort_keys=True).encode(),
+            _pss(),
+            hashes.SHA256()
+        )
+        response_data["signature"] = base64.b64encode(signature).decode()
+        return web.json_response(response_data)
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/ipek", self.get_ipek)
+        return app
+
+
+class PassthroughStandIn:
+    """
+    Authorizes the API keys it was given, answering with their EPX credentials
+    """
+
+    def __init__(self, credentials_by_key: Dict[str, Dict[str, Any]]):
+        self.credentials_by_key = credentials_by_key
+
+    async def authorize(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        credentials = self.credentials_by_key.get(body.get("auth_key"))
+        if credentials is None:
+            return web.json_response({"authorized": False})
+        return web.json_response({"authorized": True, **credentials})
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/passthrough", self.authorize)
+        return app
+
+
+# Set by the gateway on every request, so never part of what identifies one
+EPX_PER_REQUEST_FIELDS = ("BATCH_ID", "TRAN_NBR")
+
+
+def epx_request_signature(fields: List[Any]) -> str:
+    """
+    Returns an EPX request body, in its order, less the fields the gateway sets per request.
+
+    :param fields: List of (key, value) pairs
+    :return: str
+    """
+    return parse.urlencode([(key, value) for key, value in fields if key not in EPX_PER_REQUEST_FIELDS])
+
+
+class EPXStandIn:
+    """
+    Answers EPX requests with the responses recorded for them, as EPX's XML.
+
+    Responses are looked up by request signature. Where several were
+    recorded for the same request they are handed out in turn. Requests
+    nothing was recorded for get a 500 and are counted as unmatched.
+    """
+
+    def __init__(self, responses: Dict[str, List[Dict[str, Optional[str]]]]):
+        self.responses = responses
+        self.turns = {signature: count() for signature in responses}
+        self.unmatched = 0
+
+    @staticmethod
+    def to_xml(fields: Dict[str, Optional[str]]) -> str:
+        # EPX leaves out fields it has no value for
+        return "<RESPONSE><FIELDS>{}</FIELDS></RESPONSE>".format("".join(
+            f"<FIELD KEY={quoteattr(key)}>{escape(value)}</FIELD>"
+            for key, value in fields.items()
+            if value is not None
+        ))
+
+    async def transact(self, request: web.Request) -> web.Response:
+        signature = epx_request_signature(parse.parse_qsl(await request.text(), keep_blank_values=True))
+        responses = self.responses.get(signature)
+        if not responses:
+            self.unmatched += 1
+            return web.Response(status=500, text="No response recorded for this request")
+
+        fields = responses[next(self.turns[signature]) % len(responses)]
+        return web.Response(text=self.to_xml(fields), content_type="text/xml")
+
+    async def probe(self, request: web.Request) -> web.Response:
+        return web.Response(text="OK")
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/", self.transact)
+        app.router.add_get("/", self.probe)
+        return app
+
+
+async def start_site(app: web.Application, port: Union[int, str], host: str = "127.0.0.1") -> web.AppRunner:
+    """
+    Serves an application in the running event loop, returning its runner for cleanup.
+
+    A port given as `unix:///path` serves on that Unix domain socket instead.
+    """
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    if isinstance(port, str) and port.startswith("unix://"):
+        await web.UnixSite(runner, port[len("unix://"):]).start()
+    else:
+        await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def start_key_injection_stand_ins(
+    registry_port: Union[int, str] = REGISTRY_PORT,
+    cryptography_port: Union[int, str] = CRYPTOGRAPHY_PORT,
+):
+    """
+    Starts the registry and cryptography stand-ins, returning their runners.
+    """
+    service_private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    service_public_key_pem = service_private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+
+    return [
+        await start_site(RegistryStandIn(service_public_key_pem).application(), registry_port),
+        await start_site(CryptographyStandIn(service_private_key).application(), cryptography_port),
+    ]
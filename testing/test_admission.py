@@ -0,0 +1,47 @@
+import asyncio
+
+from service.admission import AdmissionController, Priority
+from service.scheduling import FairScheduler
+
+
+def test_limit_follows_upstream_time_not_waiting():
+    controller = AdmissionController(initial_limit=10, target_latency=0.05)
+    scheduler = FairScheduler(capacity=1, rate=0, burst=1)
+
+    async def request(hold: float) -> None:
+        async with controller.admit(Priority.TRANSACTION):
+            async with scheduler.slot("a"):
+                await asyncio.sleep(hold)
+
+    async def main() -> None:
+        # Each waits behind the others for the single slot, well over the
+        # target in all, but every call itself is quick
+        await asyncio.gather(*(request(0.02) for _ in range(5)))
+
+    asyncio.run(main())
+    assert controller.limit >= 10
+
+
+def test_slow_upstream_shrinks_the_limit():
+    controller = AdmissionController(initial_limit=10, target_latency=0.01)
+    scheduler = FairScheduler(capacity=1, rate=0, burst=1)
+
+    async def main() -> None:
+        async with controller.admit(Priority.TRANSACTION):
+            async with scheduler.slot("a"):
+                await asyncio.sleep(0.02)
+
+    asyncio.run(main())
+    assert controller.limit < 10
+
+
+def test_requests_without_upstream_calls_leave_the_limit_alone():
+    controller = AdmissionController(initial_limit=10, target_latency=0.01)
+
+    async def main() -> None:
+        async with controller.admit(Priority.TRANSACTION):
+            await asyncio.sleep(0.02)
+
+    asyncio.run(main())
+    assert controller.limit == 10
+    assert controller.in_flight == 0
@@ -0,0 +1,31 @@
+import asyncio
+
+from service import callbacks, jobs
+from service.deadline import current_deadline
+from service.models import EPXCredentials
+from service.scheduling import current_tenant
+
+
+def test_callback_is_delivered_as_the_submitting_tenant(monkeypatch):
+    delivered = {}
+
+    async def deliver_callback(url, payload, key):
+        delivered["tenant"] = current_tenant()
+        delivered["budget"] = current_deadline().budget
+        delivered["key"] = key
+
+    monkeypatch.setattr(jobs, "deliver_callback", deliver_callback)
+    job = jobs.TransactionJob(
+        id="job",
+        owner="tenant-hash",
+        credentials=EPXCredentials(CUST_NBR=1, MERCH_NBR=2, DBA_NBR=3, TERMINAL_NBR=4),
+        request=None,
+        is_qa=True,
+        callback_url="https://example.com/callback",
+        callback_key="api-key",
+    )
+
+    asyncio.run(jobs.TransactionJobs._callback(job))
+
+    assert delivered == {"tenant": "tenant-hash", "budget": callbacks.CALLBACK_TIMEOUT, "key": "api-key"}
+    assert job.callback_key is None
@@ -0,0 +1,31 @@
+import importlib
+import os
+import subprocess
+import sys
+
+from service.models import TransactionResponse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def test_export_runs_without_loading_the_gateway(tmp_path):
+    # service/__init__ exports the journal instance under the module's name
+    journal_module = importlib.import_module("service.journal")
+    journal = journal_module.TransactionJournal(str(tmp_path))
+    journal.record(
+        {"TRAN_TYPE": "CCE1", "TRAN_NBR": "7", "TRACK_DATA": "4111111111111111"},
+        TransactionResponse(AUTH_RESP="00", AUTH_RESP_TEXT="APPROVAL"),
+    )
+    journal.stop()
+
+    export = subprocess.run(
+        [sys.executable, "-X", "importtime", "-W", "error", os.path.join(ROOT, "service", "journal_export.py"), str(tmp_path)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert "CCE1 Transaction 7" in export.stdout
+    assert "TRACK_DATA=4111********1111" in export.stdout
+    assert "Exported 1 transactions" in export.stderr
+    assert "sanic" not in export.stderr
@@ -0,0 +1,319 @@
+"""
+Per-request memory budgets for the gateway's /p2pe routes.
+
+Runs the gateway in the test process against the stand-ins (served from
+a child process, so their allocations are not counted) and drives each
+route with tracemalloc on, one request at a time. After a warm up, each
+route is measured over MEMORY_BUDGET_WINDOWS consecutive windows of the
+same number of requests:
+
+- peak: the most memory any single request had allocated at once, over
+  what was allocated before it started, must stay within its budget
+- retained: the memory still held at the end of each window, once the
+  garbage collector has run, by allocations with a frame in service/
+
+Counting only what the gateway's own code allocated, from snapshot
+traces, keeps the test runner, the client driving the routes and
+tracemalloc's own bookkeeping out of the measurement. A leak grows the
+retained memory steadily, while caches filling up grow it once and
+buffers and pools resizing move a single window either way.
+So a route fails when the least squares slope of the retained memory
+over the windows is more than the tolerance.
+
+The test takes minutes, so it only runs when asked for:
+
+    MEMORY_BUDGET=true python -m pytest -q testing/test_memory_budget.py
+
+MEMORY_BUDGET_ITERATIONS (requests per window, default 400),
+MEMORY_BUDGET_WINDOWS (default 5) and MEMORY_BUDGET_WARM_UP (default 500)
+trade run time for sensitivity. A leak is caught once it adds up to
+MEMORY_BUDGET_LEAK_TOLERANCE bytes (default 16KB) per window, 40 bytes a
+request at the defaults. Retained memory moves by a few tens of KB from
+one window to the next with no leak at all, which the default leaves the
+slope well clear of.
+"""
+import asyncio
+import base64
+from array import array
+import gc
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import tracemalloc
+import uuid
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List
+
+import aiohttp
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from certification_replay import CERTIFICATION_FILE, parse_certification
+from stand_ins import EPXStandIn, PassthroughStandIn, start_key_injection_stand_ins, start_site
+
+API_KEY = "memory-budget"
+METRICS_TOKEN = "memory-budget-metrics"
+
+ENABLED = os.getenv("MEMORY_BUDGET", "False").lower() == "true"
+ITERATIONS = int(os.getenv("MEMORY_BUDGET_ITERATIONS", "400"))
+WINDOWS = int(os.getenv("MEMORY_BUDGET_WINDOWS", "5"))
+WARM_UP = int(os.getenv("MEMORY_BUDGET_WARM_UP", "500"))
+# Stack frames tracemalloc keeps per allocation. Library code allocating
+# on the gateway's behalf is only attributed to it when its frame is kept.
+FRAMES = int(os.getenv("MEMORY_BUDGET_FRAMES", "16"))
+# Growth of the retained memory allowed per window, for buffers and pools changing size
+LEAK_TOLERANCE = int(os.getenv("MEMORY_BUDGET_LEAK_TOLERANCE", str(16 * 1024)))
+
+# Allocations made with any of the gateway's own frames on the stack
+SERVICE_ALLOCATIONS = tracemalloc.Filter(True, f"*{os.sep}service{os.sep}*", all_frames=True)
+
+pytestmark = pytest.mark.skipif(not ENABLED, reason="Takes minutes, set MEMORY_BUDGET=true to run it")
+
+# Peak KB per request, about 1.5x what the routes measured at
+PEAK_BUDGETS: Dict[str, float] = {
+    "transaction": 448,
+    "transaction_async": 448,
+    "transaction_lookup": 384,
+    "register_terminal": 384,
+    "get_key": 448,
+    "metrics": 384,
+}
+
+
+@dataclass
+class RouteMemory:
+    """What one route cost in memory"""
+    route: str
+    iterations: int
+    peak_median: float
+    peak_max: float
+    retained: List[int]
+    growth: float
+
+    def report(self) -> str:
+        retained = ", ".join(f"{size / 1024:.1f}" for size in self.retained)
+        return (
+            f"{self.route}: peak p50 {self.peak_median / 1024:.1f}KB, max {self.peak_max / 1024:.1f}KB; "
+            f"retained {retained}KB, growing {self.growth:.0f}B per window of {self.iterations} requests"
+        )
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def serve_stand_ins(ports: Dict[str, int], ready) -> None:
+    """Child process: serves every stand-in until it is terminated"""
+    with open(CERTIFICATION_FILE) as f:
+        fixtures, _ = parse_certification(f.read())
+    fixture = fixtures[0]
+
+    async def serve() -> None:
+        await start_key_injection_stand_ins(ports["registry"], ports["cryptography"])
+        await start_site(EPXStandIn({fixture.signature: [fixture.response]}).application(), ports["epx"])
+        await start_site(PassthroughStandIn({API_KEY: fixture.credentials}).application(), ports["passthrough"])
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def configure_gateway(ports: Dict[str, int]) -> None:
+    """Points the gateway at the stand-ins, before it is imported"""
+    os.environ.update({
+        "IS_QA": "true",
+        "EPX_QA_ENDPOINTS": f"http://127.0.0.1:{ports['epx']}",
+        "PASSTHROUGH_ADDRESS": f"http://127.0.0.1:{ports['passthrough']}",
+        "IPEK_REGISTRY_QA_ADDRESS": f"http://127.0.0.1:{ports['registry']}",
+        "CRYPTOGRAPHY_QA_ADDRESS": f"http://127.0.0.1:{ports['cryptography']}",
+        "METRICS_TOKEN": METRICS_TOKEN,
+        # Small enough to fill up during warm up, so only leaks keep growing
+        "TRANSACTION_INDEX_SIZE": "100",
+        "TRANSACTION_JOB_TTL": "0.5",
+        # Log lines would be counted against every request
+        "LOG_LEVEL": "40",
+    })
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def route_drivers(session: aiohttp.ClientSession, gateway: str) -> Dict[str, Callable[[], Awaitable[None]]]:
+    """One coroutine function per route, each making one complete request"""
+    with open(CERTIFICATION_FILE) as f:
+        fixtures, _ = parse_certification(f.read())
+    transaction_payload = fixtures[0].payload
+    headers = {"Authorization": f"Bearer {API_KEY}"}
+
+    public_key_pem = rsa.generate_private_key(public_exponent=65537, key_size=2048).public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+    terminal_id = f"MEM{uuid.uuid4().hex[:8].upper()}"
+
+    async def call(method: str, path: str, extra_headers: Dict[str, str] = None, **kwargs) -> Dict:
+        request_headers = {**headers, **(extra_headers or {})}
+        async with session.request(method, f"{gateway}/p2pe{path}", headers=request_headers, **kwargs) as response:
+            body = await response.json()
+            if response.status >= 300:
+                raise RuntimeError(f"{method} {path} answered {response.status}: {body}")
+            return body
+
+    async def transaction() -> None:
+        await call("POST", "/transaction", json=transaction_payload)
+
+    async def transaction_async() -> None:
+        job = await call("POST", "/transaction", json=transaction_payload, extra_headers={"Prefer": "respond-async"})
+        while job["status"] == "pending":
+            await asyncio.sleep(0.001)
+            job = await call("GET", f"/transaction/{job['id']}")
+
+    async def transaction_lookup() -> None:
+        await call("GET", "/transaction/lookup", params={"terminal_nbr": fixtures[0].credentials["TERMINAL_NBR"]})
+
+    async def register_terminal() -> None:
+        await call("POST", "/register-terminal-for-remote-key-injection", json={
+            "terminal_id": terminal_id,
+            "public_key": public_key_pem,
+        })
+
+    async def get_key() -> None:
+        await call("POST", "/get-key-from-registered-terminal-for-remote-key-injection", json={
+            "terminal_id": terminal_id,
+            # Every attempt needs a fresh nonce, the gateway rejects replays
+            "nonce": str(uuid.uuid4()),
+            "signature": base64.b64encode(os.urandom(256)).decode(),
+        })
+
+    async def metrics() -> None:
+        await call("GET", "/metrics", extra_headers={"Authorization": f"Bearer {METRICS_TOKEN}"})
+
+    return {
+        "transaction": transaction,
+        "transaction_async": transaction_async,
+        "transaction_lookup": transaction_lookup,
+        "register_terminal": register_terminal,
+        "get_key": get_key,
+        "metrics": metrics,
+    }
+
+
+def retained_by_service() -> int:
+    """
+    Returns the bytes currently held by allocations made on the gateway's behalf.
+    """
+    gc.collect()
+    snapshot = tracemalloc.take_snapshot().filter_traces([SERVICE_ALLOCATIONS])
+    return sum(trace.size for trace in snapshot.traces)
+
+
+async def measure_window(drive: Callable[[], Awaitable[None]], iterations: int) -> array:
+    """
+    Makes `iterations` requests, returning each one's peak.
+    """
+    peaks = array("q", bytes(8 * iterations))
+    for i in range(iterations):
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        await drive()
+        _, peak = tracemalloc.get_traced_memory()
+        peaks[i] = peak - start
+    return peaks
+
+
+async def measure(route: str, drive: Callable[[], Awaitable[None]]) -> RouteMemory:
+    for _ in range(WARM_UP):
+        await drive()
+
+    peaks = array("q")
+    retained = [retained_by_service()]
+    for _ in range(WINDOWS):
+        peaks.extend(await measure_window(drive, ITERATIONS))
+        retained.append(retained_by_service())
+
+    growth, _ = statistics.linear_regression(range(len(retained)), retained)
+    return RouteMemory(route, ITERATIONS, statistics.median(peaks), max(peaks), retained, growth)
+
+
+class Gateway:
+    """The gateway serving in this process, its stand-ins, and a client session driving its routes"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.ports = {name: free_port() for name in ("gateway", "registry", "cryptography", "epx", "passthrough")}
+        self.stand_ins = None
+        self.server = None
+        self.session = None
+        self.drivers: Dict[str, Callable[[], Awaitable[None]]] = {}
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def start(self) -> None:
+        ready = multiprocessing.Event()
+        self.stand_ins = multiprocessing.Process(target=serve_stand_ins, args=(self.ports, ready), daemon=True)
+        self.stand_ins.start()
+        if not ready.wait(30):
+            raise RuntimeError("The stand-ins did not start")
+
+        configure_gateway(self.ports)
+        self.run(self._start())
+
+    async def _start(self) -> None:
+        from service import app
+
+        self.server = await app.create_server(
+            host="127.0.0.1", port=self.ports["gateway"], return_asyncio_server=True, access_log=False
+        )
+        await self.server.startup()
+        await self.server.before_start()
+        await self.server.after_start()
+
+        self.session = aiohttp.ClientSession()
+        self.drivers = route_drivers(self.session, f"http://127.0.0.1:{self.ports['gateway']}")
+        # Both key injection routes need the terminal registered
+        await self.drivers["register_terminal"]()
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.run(self._stop())
+        if self.stand_ins is not None:
+            self.stand_ins.terminate()
+        self.loop.close()
+
+    async def _stop(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+        await self.server.before_stop()
+        await self.server.close()
+        await self.server.after_stop()
+
+
+@pytest.fixture(scope="module")
+def gateway():
+    gateway = Gateway()
+    # pytest keeps every log record of a test for its report, which would look like a leak
+    logging.disable(logging.WARNING)
+    try:
+        gateway.start()
+        tracemalloc.start(FRAMES)
+        yield gateway
+    finally:
+        tracemalloc.stop()
+        gateway.stop()
+        logging.disable(logging.NOTSET)
+
+
+@pytest.mark.parametrize("route", sorted(PEAK_BUDGETS))
+def test_route_memory(gateway: Gateway, route: str) -> None:
+    memory = gateway.run(measure(route, gateway.drivers[route]))
+    print(memory.report())
+
+    assert memory.peak_max <= PEAK_BUDGETS[route] * 1024, (
+        f"{route}: peak of {memory.peak_max / 1024:.1f}KB is over its {PEAK_BUDGETS[route]}KB budget"
+    )
+    assert memory.growth <= LEAK_TOLERANCE, f"{route}: kept growing, {memory.report()}"
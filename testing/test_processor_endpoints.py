@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from service.deadline import DeadlineExceeded, deadline_scope
+from service.epx import EPXProcessor
+from service.models import EPXCredentials
+from service.processor_endpoints import ProcessorEndpointRegistry
+
+
+async def hanging_endpoint(port: int) -> web.AppRunner:
+    async def hang(request: web.Request) -> web.Response:
+        await asyncio.sleep(2)
+        return web.Response()
+
+    application = web.Application()
+    application.router.add_post("/", hang)
+    runner = web.AppRunner(application, shutdown_timeout=0)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def charge_with_deadline(port: int, budget: float, monkeypatch) -> ProcessorEndpointRegistry:
+    monkeypatch.setattr("service.epx.PROBE_TIMEOUT", 0.4)
+    registry = ProcessorEndpointRegistry([f"http://127.0.0.1:{port}"])
+    processor = EPXProcessor(EPXCredentials(CUST_NBR=1, MERCH_NBR=2, DBA_NBR=3, TERMINAL_NBR=4))
+    processor.endpoints = registry
+
+    runner = await hanging_endpoint(port)
+    try:
+        with deadline_scope(budget), pytest.raises(DeadlineExceeded):
+            await processor.transmit({})
+    finally:
+        await registry.endpoints[0].upstream.close()
+        await runner.cleanup()
+    return registry
+
+
+def test_timeout_from_a_short_deadline_is_not_the_endpoints_fault(unused_tcp_port, monkeypatch):
+    registry = asyncio.run(charge_with_deadline(unused_tcp_port, 0.3, monkeypatch))
+    assert registry.endpoints[0].failures == 0
+
+
+def test_timeout_with_time_to_spare_counts_against_the_endpoint(unused_tcp_port, monkeypatch):
+    registry = asyncio.run(charge_with_deadline(unused_tcp_port, 0.6, monkeypatch))
+    assert registry.endpoints[0].failures == 1
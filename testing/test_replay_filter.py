@@ -0,0 +1,22 @@
+import pytest
+
+from service.replay_filter import NonceReplayed, NonceReplayFilter
+
+
+def test_replayed_nonce_is_rejected():
+    nonce_filter = NonceReplayFilter(window=300, generations=2, capacity=100)
+    nonce_filter.check("T1", "a")
+    nonce_filter.check("T2", "a")
+    with pytest.raises(NonceReplayed):
+        nonce_filter.check("T1", "a")
+    assert nonce_filter.rejected == 1
+
+
+def test_full_generation_is_rotated_early():
+    nonce_filter = NonceReplayFilter(window=300, generations=2, capacity=10)
+    for i in range(25):
+        nonce_filter.check("T1", str(i))
+
+    assert nonce_filter.early_rotations == 2
+    assert all(generation.added <= 10 for generation in nonce_filter.generations)
+    assert nonce_filter.snapshot()["early_rotations"] == 2
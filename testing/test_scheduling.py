@@ -0,0 +1,66 @@
+"""
+Unit tests for the per-tenant fair scheduler.
+"""
+import asyncio
+
+from service.scheduling import FairScheduler
+
+
+async def call(scheduler: FairScheduler, tenant: str) -> None:
+    async with scheduler.slot(tenant):
+        pass
+
+
+def test_tenants_are_capped():
+    scheduler = FairScheduler(max_tenants=100)
+
+    async def calls():
+        for i in range(1000):
+            await call(scheduler, f"tenant-{i}")
+
+    asyncio.run(calls())
+    assert len(scheduler.tenants) == 100
+    assert scheduler.forgotten == 900
+    # The most recent callers are the ones kept
+    assert list(scheduler.tenants)[-1] == "tenant-999"
+
+
+def test_recently_used_tenants_are_kept():
+    scheduler = FairScheduler(max_tenants=3)
+
+    async def calls():
+        for name in ("a", "b", "c", "a", "d"):
+            await call(scheduler, name)
+
+    asyncio.run(calls())
+    assert list(scheduler.tenants) == ["c", "a", "d"]
+
+
+def test_busy_tenants_are_not_forgotten():
+    scheduler = FairScheduler(max_tenants=2)
+
+    async def calls():
+        async with scheduler.slot("busy"):
+            for i in range(10):
+                await call(scheduler, f"tenant-{i}")
+            assert "busy" in scheduler.tenants
+        assert scheduler.in_use == 0
+
+    asyncio.run(calls())
+    assert len(scheduler.tenants) == 2
+
+
+def test_tenants_are_not_rate_limited_by_default():
+    scheduler = FairScheduler(rate=0, burst=1)
+    tenant = scheduler.tenant("a")
+    assert [tenant.take_token() for _ in range(10)] == [0.0] * 10
+    assert scheduler.tenants["a"].throttled == 0
+
+
+def test_rate_limit_when_set():
+    scheduler = FairScheduler(rate=10, burst=2)
+    tenant = scheduler.tenant("a")
+    assert tenant.take_token() == 0.0
+    assert tenant.take_token() == 0.0
+    # The third call waits about a tenth of a second for its token
+    assert 0.09 < tenant.take_token() <= 0.1